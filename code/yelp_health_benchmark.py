@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Yelp Pipeline Benchmark
+# * Generate synthetic gzip'd stacked-JSON snapshots in the shape Yelp delivers (facilities with location, categories and reviews)
+# * Time the decode, extract, csv write, summary and upload stages of yelp_health_pipeline against a local stand-in for s3
+# * Decoding is also timed with each installed json backend, for facilities/sec per backend
+# * Report throughput and peak memory per stage, and flag regressions against a stored baseline
+
+# In[1]:
+
+
+# Modules
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import yelp_health_pipeline as pipeline
+
+
+# ## Program Parameters
+
+# In[2]:
+
+
+# Constants
+BENCHMARK_FACILITIES = 20000 # facilities in the generated snapshot
+BENCHMARK_SEED = 0
+BENCHMARK_PATH = '/home/ec2-user/yelp/benchmark/' # scratch directory - snapshots, master files and the local s3 stand-in
+BASELINE_FILE = BENCHMARK_PATH + 'benchmark_baseline.json'
+REGRESSION_TOLERANCE = 0.15 # fractional slowdown against the baseline reported as a regression
+MEASURE_MEMORY = True # second pass of each stage under tracemalloc for peak memory (kept out of the timings)
+
+STAGES = ['decode', 'extract', 'csv_write', 'summary', 'upload']
+
+# Values drawn on for the synthetic facilities
+CITIES = [('Philadelphia', 'PA', '191'), ('Pittsburgh', 'PA', '152'), ('Camden', 'NJ', '081'), ('Newark', 'NJ', '071'),
+          ('Wilmington', 'DE', '198'), ('Baltimore', 'MD', '212'), ('New York', 'NY', '100'), ('Boston', 'MA', '021')]
+CATEGORIES = ['dentists', 'generaldentistry', 'hospitals', 'physicians', 'familydr', 'optometrists', 'chiropractors',
+              'physicaltherapy', 'urgent_care', 'pediatricians', 'dermatology', 'obgyn', 'pharmacy', 'psychiatrists',
+              'counseling', 'orthodontists', 'podiatrists', 'medcenters', 'diagnosticservices', 'laboratorytesting']
+WORDS = ['the', 'staff', 'was', 'very', 'friendly', 'and', 'doctor', 'wait', 'time', 'appointment', 'office', 'clean',
+         'insurance', 'front', 'desk', 'recommend', 'great', 'rude', 'helpful', 'hours', 'parking', 'care', 'visit']
+
+
+# ## Synthetic Snapshots
+
+# In[3]:
+
+
+def generate_facility(i, rnd):
+    # One facility with the fields extract_facilities reads - Yelp returns up to 3 reviews per facility
+    city, state, zip_prefix = rnd.choice(CITIES)
+    categories = rnd.sample(CATEGORIES, rnd.randint(1, 3))
+    reviews = []
+    for j in range(rnd.choice([0, 1, 2, 3, 3, 3])):
+        reviews.append({'id': 'r%07d%02d%s' % (i, j, rnd.getrandbits(40)),
+                        'rating': rnd.randint(1, 5),
+                        'text': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 40))).capitalize() + '...',
+                        'user': {'name': 'User %d.' % rnd.randint(1, 99999),
+                                 'image_url': 'https://s3-media.fl.yelpcdn.com/photo/%d/o.jpg' % rnd.getrandbits(32)},
+                        'created': '2019-%02d-%02d %02d:%02d:00' % (rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59)),
+                        'url': 'https://www.yelp.com/biz/facility-%d?hrid=%d' % (i, rnd.getrandbits(32)),
+                        'is_selected': rnd.random() < 0.5})
+    return {'id': 'f%09d%s' % (i, rnd.getrandbits(32)),
+            'name': 'Facility %d %s' % (i, rnd.choice(CATEGORIES).title()),
+            'is_closed': rnd.random() < 0.05,
+            'review_count': rnd.randint(0, 600),
+            'rating': rnd.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]),
+            'time_updated': '2020-01-%02dT%02d:%02d:00Z' % (rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59)),
+            'phone': '+1%010d' % rnd.randint(2000000000, 9999999999),
+            'business_url': 'http://www.facility%d.com' % i if rnd.random() < 0.6 else None,
+            'url': 'https://www.yelp.com/biz/facility-%d' % i,
+            'location': {'address': ['%d Main St' % rnd.randint(1, 9999), 'Ste %d' % rnd.randint(1, 500) if rnd.random() < 0.3 else None, ''],
+                         'city': city, 'state': state, 'country': 'US',
+                         'postal_code': zip_prefix + '%02d' % rnd.randint(0, 99),
+                         'coordinate': {'latitude': round(39 + rnd.random() * 3, 6), 'longitude': round(-77 + rnd.random() * 6, 6)}},
+            'categories': [{'alias': alias, 'title': alias.title()} for alias in categories],
+            'reviews': reviews}
+
+
+def generate_snapshot(file_path, facilities=BENCHMARK_FACILITIES, seed=BENCHMARK_SEED):
+    # gzip'd stacked JSON - one facility object per line, like the upenn/ snapshots - returns the uncompressed size
+    rnd = random.Random(seed)
+    size = 0
+    with gzip.open(file_path, 'wb') as f:
+        for i in range(facilities):
+            line = (json.dumps(generate_facility(i, rnd)) + '\n').encode('utf-8')
+            f.write(line)
+            size += len(line)
+    return size
+
+
+# ## Local S3 Stand-in
+
+# In[4]:
+
+
+class LocalBody(io.BytesIO):
+    # get_object body - a BytesIO that also answers iter_chunks like botocore's StreamingBody
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.read(chunk_size), b'')
+
+
+class LocalPaginator:
+    def __init__(self, client, operation):
+        self.method = getattr(client, operation)
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class LocalS3:
+    # In-process stand-in for the boto3 s3 client calls the pipeline makes, backed by a local directory
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def missing(self, operation):
+        raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, operation)
+
+    def etag(self, file_path):
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                md5.update(chunk)
+        return '"' + md5.hexdigest() + '"'
+
+    def create_bucket(self, Bucket, **kwargs):
+        os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        file_path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': self.etag(file_path)}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        file_path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        shutil.copyfile(Filename, file_path)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        if not os.path.exists(self.path(Bucket, Key)):
+            self.missing('GetObject')
+        shutil.copyfile(self.path(Bucket, Key), Filename)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        file_path = self.path(Bucket, Key)
+        if not os.path.exists(file_path):
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': os.path.getsize(file_path), 'ETag': self.etag(file_path)}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **kwargs):
+        file_path = self.path(Bucket, Key)
+        if not os.path.exists(file_path):
+            self.missing('GetObject')
+        etag = self.etag(file_path)
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        with open(file_path, 'rb') as f:
+            if Range:
+                start, end = [int(pos) for pos in Range.split('=')[1].split('-')]
+                f.seek(start)
+                body = f.read(end - start + 1)
+            else:
+                body = f.read()
+        return {'Body': LocalBody(body), 'ETag': etag, 'ContentLength': len(body)}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        bucket_path = os.path.join(self.root, Bucket)
+        contents = []
+        for dir_path, dir_names, file_names in os.walk(bucket_path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(file_path, bucket_path).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    contents.append({'Key': key, 'Size': os.path.getsize(file_path), 'StorageClass': 'STANDARD',
+                                     'LastModified': datetime.fromtimestamp(os.path.getmtime(file_path))})
+        contents = sorted(contents, key=lambda item: item['Key'])
+        response = {'KeyCount': len(contents), 'IsTruncated': False}
+        if contents:
+            response['Contents'] = contents
+        return response
+
+    def list_objects(self, Bucket, **kwargs):
+        return self.list_objects_v2(Bucket, **kwargs)
+
+    def get_paginator(self, operation):
+        return LocalPaginator(self, operation)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = '%s/%s/%d' % (Bucket, Key, len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.put_object(Bucket, Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+# ## Benchmark
+
+# In[5]:
+
+
+def setup_pipeline(root):
+    # Point the pipeline's paths and s3 clients at the scratch directory and the local stand-in
+    for name in ['ZIP', 'JSON', 'MASTER', 'SUMMARY', 'LOG', 'DELTA', 'STORE', 'INDEX']:
+        path = root + name.lower() + '_files/'
+        os.makedirs(path, exist_ok=True)
+        setattr(pipeline, name + '_PATH', path)
+    pipeline.BASE_PATH = root
+    s3 = LocalS3(root + 's3/')
+    for bucket in [pipeline.YELP_BUCKET, pipeline.CDH_BUCKET_ZIP_GLACIER, pipeline.CDH_BUCKET_JSON_GLACIER,
+                   pipeline.CDH_BUCKET_MASTER_GLACIER, pipeline.CDH_BUCKET_MASTER, pipeline.CDH_BUCKET_AUX]:
+        s3.create_bucket(Bucket=bucket)
+    s3.put_object(Bucket=pipeline.CDH_BUCKET_AUX, Key='daily_data.csv',
+                  Body=(',' + ','.join(pipeline.SUMMARY_COLS) + '\n').encode('utf-8'))
+    pipeline.s3_cdh = s3
+    pipeline.s3_yelp = s3
+    pipeline.bucket_keys.clear()
+    return s3
+
+
+def run_stage(name, function, memory=MEASURE_MEMORY):
+    # Time one stage, then optionally repeat it under tracemalloc for its peak python memory
+    start = time.perf_counter()
+    result, items, size = function()
+    seconds = time.perf_counter() - start
+    stats = {'seconds': seconds, 'items': items, 'bytes': size,
+             'items_per_sec': items / seconds if seconds else None,
+             'mb_per_sec': size / 2**20 / seconds if seconds and size else None}
+    if memory:
+        tracemalloc.start()
+        function()
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    print('%-14s %8.3fs %12s items/s %10s MB/s %10s MB peak' % (
+        name, seconds,
+        '%.0f' % stats['items_per_sec'] if stats['items_per_sec'] else '-',
+        '%.1f' % stats['mb_per_sec'] if stats['mb_per_sec'] else '-',
+        '%.1f' % stats['peak_mb'] if 'peak_mb' in stats else '-'))
+    return result, stats
+
+
+def run_benchmark(facilities=BENCHMARK_FACILITIES, seed=BENCHMARK_SEED, path=BENCHMARK_PATH, memory=MEASURE_MEMORY):
+    root = tempfile.mkdtemp(dir=path) + '/'
+    setup_pipeline(root)
+    file_name = '20200101'
+    zip_file_path = pipeline.ZIP_PATH + file_name + '_upenn.json.gz'
+    json_file_path = pipeline.JSON_PATH + file_name + '_upenn.json'
+
+    print('Generating', facilities, 'facilities...')
+    json_size = generate_snapshot(zip_file_path, facilities, seed)
+    with gzip.open(zip_file_path, 'rb') as f_in:
+        with open(json_file_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    print('Snapshot:', round(os.path.getsize(zip_file_path) / 2**20, 1), 'MB zipped,', round(json_size / 2**20, 1), 'MB json')
+
+    def decode(backend=None):
+        with open(json_file_path, 'rb') as f:
+            rows = list(pipeline.decode_stream(f, backend=backend))
+        return rows, len(rows), json_size
+
+    def extract():
+        tables = pipeline.extract_facilities(iter(rows))
+        return tables, len(rows), json_size
+
+    def csv_write():
+        for file in os.listdir(pipeline.MASTER_PATH):
+            os.remove(pipeline.MASTER_PATH + file)
+        fac_data, cat_data, rev_data, summary = tables
+        pipeline.write_master_files(file_name, fac_data, cat_data, rev_data)
+        size = sum(os.path.getsize(pipeline.MASTER_PATH + file) for file in os.listdir(pipeline.MASTER_PATH))
+        return None, len(rows), size
+
+    def summary():
+        accumulator = pipeline.summarize_facilities(iter(rows))
+        return accumulator.summary(file_name), len(rows), None
+
+    # Uploads remove the local files, so each pass starts from an empty bucket and a fresh copy of them
+    keep_path = root + 'keep/'
+
+    def upload():
+        shutil.rmtree(root + 's3/')
+        setup_pipeline(root)
+        size = 0
+        for path, file in local_files:
+            if not os.path.exists(path + file):
+                shutil.copyfile(keep_path + file, path + file)
+            size += os.path.getsize(path + file)
+        pipeline.save_files()
+        return None, len(local_files), size
+
+    print('%-14s %9s %18s %15s %15s' % ('stage', 'time', 'throughput', '', 'memory'))
+    results = {}
+    rows, results['decode'] = run_stage('decode', decode, memory)
+    # Items per second of the decode stages are facilities per second
+    for backend in ['stdlib'] + list(pipeline.JSON_BACKENDS):
+        _, results['decode_' + backend] = run_stage('decode_' + backend, lambda: decode(backend), memory)
+    tables, results['extract'] = run_stage('extract', extract, memory)
+    _, results['csv_write'] = run_stage('csv_write', csv_write, memory)
+    _, results['summary'] = run_stage('summary', summary, memory)
+    local_files = [(path, file) for path in [pipeline.ZIP_PATH, pipeline.JSON_PATH, pipeline.MASTER_PATH]
+                   for file in os.listdir(path)]
+    os.makedirs(keep_path, exist_ok=True)
+    for path, file in local_files:
+        shutil.copyfile(path + file, keep_path + file)
+    _, results['upload'] = run_stage('upload', upload, memory)
+
+    shutil.rmtree(root)
+    return {'timestamp': datetime.now().isoformat(), 'facilities': facilities, 'seed': seed,
+            'json_bytes': json_size, 'stages': results}
+
+
+# In[6]:
+
+
+def compare_to_baseline(report, baseline_file=BASELINE_FILE, tolerance=REGRESSION_TOLERANCE):
+    # Stages slower than the baseline by more than tolerance - only comparable at the same scale and seed
+    if not os.path.exists(baseline_file):
+        print('No baseline at', baseline_file)
+        return []
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if (baseline['facilities'], baseline['seed']) != (report['facilities'], report['seed']):
+        print('Baseline was run with', baseline['facilities'], 'facilities and seed', baseline['seed'], '- not comparable')
+        return []
+
+    # Backend decode stages are compared when both runs have them
+    regressions = []
+    for stage in STAGES + sorted(stage for stage in report['stages'] if stage.startswith('decode_') and stage in baseline['stages']):
+        before = baseline['stages'][stage]['seconds']
+        after = report['stages'][stage]['seconds']
+        change = (after - before) / before if before else 0
+        flag = 'REGRESSION' if change > tolerance else ''
+        print('%-14s %8.3fs -> %8.3fs %+7.1f%% %s' % (stage, before, after, change * 100, flag))
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+
+def save_baseline(report, baseline_file=BASELINE_FILE):
+    os.makedirs(os.path.dirname(baseline_file), exist_ok=True)
+    with open(baseline_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Baseline saved to', baseline_file)
+
+
+# ## Main Program
+
+# In[7]:
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Yelp pipeline stages on a synthetic snapshot')
+    parser.add_argument('--facilities', type=int, default=BENCHMARK_FACILITIES)
+    parser.add_argument('--seed', type=int, default=BENCHMARK_SEED)
+    parser.add_argument('--path', default=BENCHMARK_PATH, help='scratch directory')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc passes')
+    parser.add_argument('--decoder', default=pipeline.JSON_DECODER, choices=['auto', 'stdlib'] + list(pipeline.JSON_BACKENDS),
+                        help='json backend for the decode stage')
+    parser.add_argument('--compression', default=pipeline.MASTER_COMPRESSION, choices=[codec for codec in pipeline.CSV_EXTENSIONS if codec],
+                        help='codec the csv_write stage streams the master csvs through - plain csv if not given')
+    args = parser.parse_args()
+
+    pipeline.JSON_DECODER = args.decoder
+    pipeline.MASTER_COMPRESSION = args.compression
+    os.makedirs(args.path, exist_ok=True)
+    report = run_benchmark(args.facilities, args.seed, args.path, not args.no_memory)
+    regressions = compare_to_baseline(report, args.baseline)
+    if args.save_baseline:
+        save_baseline(report, args.baseline)
+    sys.exit(1 if regressions else 0)
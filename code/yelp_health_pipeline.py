@@ -24,20 +24,54 @@ from time import gmtime, strftime
 
 import glob
 import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import queue
 import gzip
+import bz2
+import lzma
+import codecs
+import itertools
 import shutil
+import mmap
+from array import array
 import re
 import json
+import pickle
+import hashlib
+import sqlite3
+import time
+import signal
+import resource
+import contextlib
+import asyncio
+import functools
 from json import JSONDecoder, JSONDecodeError
 from pandas.io.json import json_normalize
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import boto3
-from botocore.exceptions import NoCredentialsError
+from botocore.exceptions import NoCredentialsError, ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from boto.s3.connection import S3Connection
 from boto.glacier.layer1 import Layer1
 from boto.glacier.concurrent import ConcurrentUploader
 
+# Optional columnar output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Optional fast json parsing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Pandas view options
 pd.set_option('display.max_columns', 100)
 pd.set_option('display.max_rows', 200)
@@ -56,15 +90,113 @@ JSON_PATH = BASE_PATH + 'json_files/'
 MASTER_PATH = BASE_PATH + 'master_files/'
 SUMMARY_PATH = BASE_PATH + 'summary_files/'
 LOG_PATH = BASE_PATH + 'logs/'
+DELTA_PATH = BASE_PATH + 'delta_files/'
+STORE_PATH = BASE_PATH + 'stores/'
+INDEX_PATH = BASE_PATH + 'index_files/'
+MANIFEST_PATH = BASE_PATH + 'manifests/'
 
 ZIP_ARCHIVE_NAME = 'yelp_zip_archive_ids.csv'
 JSON_ARCHIVE_NAME = 'yelp_json_archive_ids.csv'
 MASTER_ARCHIVE_NAME = 'yelp_master_archive_ids.csv'
+REVIEW_STORE_NAME = 'yelp_review_store.db'
+FACILITY_STORE_NAME = 'yelp_facility_store.db'
+
+# Processing parameters
+STREAM_CHUNK_SIZE = 2**20 # bytes read per chunk when stream-parsing json files
+JSON_DECODER = 'auto' # json parser for snapshots - 'orjson', 'stdlib', or 'auto' for the fastest one installed
+STREAM_FROM_GZIP = False # parse snapshots straight off the downloaded gzip instead of unzipping to JSON_PATH first
+ARCHIVE_JSON = True # when streaming from gzip, also write the json archive copy in the same pass
+PROCESS_WORKERS = 1 # snapshots processed concurrently by process_files - 1 keeps the sequential loop
+LOCAL_DISK_BUDGET = 100 * 2**30 # bytes of local disk that concurrent snapshots may take up
+DISK_EXPANSION_FACTOR = 12 # local bytes needed per downloaded zip byte (zip, json and master files)
+PARSE_WORKERS = 1 # processes parsing byte ranges of a single unzipped snapshot - 1 parses in a single stream
+PARSE_RANGES_PER_WORKER = 4 # byte ranges per parse worker, keeps each range small and the workers busy
+WRITE_PARQUET = False # also write typed parquet copies of the master tables (needs pyarrow)
+PARQUET_COMPRESSION = 'zstd'
+COLUMN_BUILDERS = False # accumulate master rows in typed column buffers rather than lists of python lists - needs pyarrow to save memory, without it strings are unpacked back into python objects
+COLUMN_BATCH_ROWS = 5000 # facilities whose rows are held as python lists before moving into the column buffers
+WRITE_DELTAS = False # write added/removed/changed records against the previous snapshot, plus a manifest
+DELTA_ONLY_UPLOADS = False # with deltas, only upload full master files on base days
+DELTA_BASE_INTERVAL = 7 # days between full base snapshots in a delta chain
+MASTER_FILE_PATTERNS = ['*.csv', '*.csv.gz', '*.csv.bz2', '*.csv.xz', '*.parquet', '*.json']
+MASTER_COMPRESSION = None # stream master and delta csvs through a compressor as they're written - 'gzip', 'bz2', 'xz' or None
+MASTER_COMPRESSION_LEVEL = 6 # compression level (the preset for xz)
+COMPRESSION_THREADS = 4 # threads compressing blocks of a csv while pandas formats the next ones
+COMPRESSION_BLOCK_SIZE = 8 * 2**20 # csv bytes compressed as one independent member of the output
+UPDATE_REVIEW_STORE = False # keep each review body once in the review store, with first and last seen dates
+REVIEW_REFS_ONLY = False # daily review files only reference rev_ids, the bodies live in the review store
+UPDATE_FACILITY_STORE = False # keep each version of each facility in the facility store, with the dates it was valid
+UPLOAD_WORKERS = 1 # files uploaded concurrently by save_files - 1 keeps the sequential loops
+UPLOAD_PART_SIZE = 64 * 2**20 # bytes per multipart upload part, files at or below this go up in a single put
+UPLOAD_PART_CONCURRENCY = 4 # parts of a single file in flight at once
+RANGED_DOWNLOADS = False # fetch snapshots as parallel byte ranges, unzipping while the download is still running
+DOWNLOAD_RANGE_SIZE = 16 * 2**20 # bytes per ranged GET
+DOWNLOAD_WORKERS = 8 # ranged GETs in flight at once
+SUMMARY_ONLY = False # only compute the daily summary row - no master tables are built or written
+EXTRACT_FIELDS = 'all' # what is parsed from each snapshot - 'all', 'facilities+categories', 'facilities' or 'summary' (same as SUMMARY_ONLY)
+SUMMARY_STORE = False # write each day's summary as its own record, compacted into daily_data.csv once per run
+SUMMARY_RECORD_PREFIX = 'summary_records/' # auxiliary bucket prefix of the per-date summary records
+METRICS_FILE = 'pipeline_metrics.jsonl' # per-stage metrics records in LOG_PATH, one json object per line
+PROFILE_FACILITIES = False # sample the facility loop's call stacks into the metrics file
+PROFILE_INTERVAL = 0.005 # seconds of cpu time between profiler samples
+PROFILE_DEPTH = 12 # frames kept per sampled stack
+PROFILE_TOP = 50 # most frequent stacks written per snapshot
+CHECKPOINTS = False # record each snapshot's finished stages in a manifest, so a rerun resumes where it failed
+CHECKPOINT_FACILITIES = 100000 # facilities parsed between checkpoints of the parse position
+PIPELINE_STAGES = False # overlap the download, parse and upload of consecutive snapshots in the sequential run
+PIPELINE_QUEUE_SIZE = 1 # snapshots waiting between two stages before the earlier stage blocks
+ASYNC_S3 = False # run bucket listings, existence checks and summary record reads as concurrent requests
+S3_CONCURRENCY = 64 # s3 requests in flight at once, also the connection pool size of each client
+ARCHIVE_MANIFEST = True # take the keys in the glacier buckets from the archive-id manifests instead of listing the buckets
 
 
 # In[3]:
 
 
+# Master table columns and types - the types are used for the columnar output
+MASTER_SCHEMAS = {
+    'facilities': [('fac_id','string'), ('fac_name','string'), ('fac_is_closed','bool'), ('review_count','int'),
+                   ('fac_rating','float'), ('fac_updated_time','timestamp'), ('phone','string'),
+                   ('business_url','string'), ('fac_url','string'), ('address','string'), ('city','dictionary'),
+                   ('state','dictionary'), ('country','dictionary'), ('postal_code','dictionary'),
+                   ('latitude','float'), ('longitude','float')],
+    'categories': [('fac_id','dictionary'), ('alias','dictionary'), ('title','dictionary')],
+    'reviews': [('fac_id','dictionary'), ('rev_id','string'), ('rev_rating','int'), ('review','string'),
+                ('user','dictionary'), ('rev_created_time','timestamp'), ('rev_url','string'),
+                ('rev_is_selected','bool')],
+}
+
+# Master tables built for each EXTRACT_FIELDS projection - review bodies are only decoded for 'all'
+EXTRACT_TABLES = {'all': ['facilities','categories','reviews'], 'facilities+categories': ['facilities','categories'],
+                  'facilities': ['facilities'], 'summary': []}
+
+# Facility members extract_facilities reads
+FACILITY_KEYS = ['id','name','is_closed','review_count','rating','time_updated','phone','business_url','url',
+                 'location','categories']
+
+# Column types of the facility store
+STORE_TYPES = {'string': 'TEXT', 'dictionary': 'TEXT', 'bool': 'INTEGER', 'int': 'INTEGER', 'float': 'REAL', 'timestamp': 'TEXT'}
+
+# Review columns kept in the daily files when the bodies live in the review store
+REVIEW_REF_COLS = ['fac_id','rev_id','rev_is_selected']
+
+# Compressed csv extensions, and the Content-Encoding each is uploaded with
+CSV_EXTENSIONS = {None: '.csv', 'gzip': '.csv.gz', 'bz2': '.csv.bz2', 'xz': '.csv.xz'}
+CONTENT_ENCODINGS = {'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz'}
+
+# Record keys used to compare a master table with the previous day's
+DELTA_KEYS = {'facilities': ['fac_id'], 'categories': ['fac_id','alias'], 'reviews': ['rev_id']}
+
+# Columns of daily_data.csv
+SUMMARY_COLS = ['date','cat_count',
+                'fac_count','fac_rating_mean','fac_rating_med',
+                'fac_rev_count_mean','fac_rev_count_med',
+                'rev_count','rev_rating_mean','rev_rating_med']
+
+
+# In[4]:
+
+
 # CDH access parameters
 CDH_ACCESS_KEY_ID = "REDACTED"
 CDH_SECRET_ACCESS_KEY = "REDACTED"
@@ -75,7 +207,7 @@ YELP_ACCESS_KEY_ID = 'REDACTED'
 YELP_SECRET_ACCESS_KEY = 'REDACTED'
 
 
-# In[4]:
+# In[5]:
 
 
 # Bucket names
@@ -86,23 +218,223 @@ CDH_BUCKET_MASTER_GLACIER = 'yelp-master-files-glacier'
 CDH_BUCKET_MASTER = 'yelp-master-files'
 CDH_BUCKET_AUX = 'yelp-auxiliary-files'
 
+# Archive-id manifests in the auxiliary bucket - the keys already archived in each glacier bucket
+ARCHIVE_MANIFESTS = {CDH_BUCKET_ZIP_GLACIER: ZIP_ARCHIVE_NAME, CDH_BUCKET_JSON_GLACIER: JSON_ARCHIVE_NAME,
+                     CDH_BUCKET_MASTER_GLACIER: MASTER_ARCHIVE_NAME}
 
-# In[5]:
+
+# In[6]:
 
 
-# Connect to s3
-s3_yelp = boto3.client('s3', aws_access_key_id=YELP_ACCESS_KEY_ID, aws_secret_access_key=YELP_SECRET_ACCESS_KEY)
-s3_cdh = boto3.client('s3', aws_access_key_id=CDH_ACCESS_KEY_ID, aws_secret_access_key=CDH_SECRET_ACCESS_KEY, region_name=CDH_REGION)
+# Connect to s3 - each client keeps a connection pool shared by all the threads using it
+S3_CONFIG = Config(max_pool_connections=S3_CONCURRENCY)
+s3_yelp = boto3.client('s3', aws_access_key_id=YELP_ACCESS_KEY_ID, aws_secret_access_key=YELP_SECRET_ACCESS_KEY, config=S3_CONFIG)
+s3_cdh = boto3.client('s3', aws_access_key_id=CDH_ACCESS_KEY_ID, aws_secret_access_key=CDH_SECRET_ACCESS_KEY, region_name=CDH_REGION, config=S3_CONFIG)
 
 
 # ## Functions
 
+# ### Metrics
+
+# In[7]:
+
+
+def write_metric(record):
+    # Append one json record to the metrics log - each line is written in a single call, so process pool workers can share the file
+    os.makedirs(LOG_PATH, exist_ok=True)
+    with open(LOG_PATH + METRICS_FILE, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets the kernel's high water mark (VmHWM) - linux only
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    # VmHWM is the peak resident size since the last reset, in kB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def stage(name, snapshot=None, **fields):
+    # Time a pipeline stage and log it - the caller fills in rows, bytes_in, bytes_out and status on the yielded record
+    record = {'time': datetime.now().isoformat(), 'stage': name, 'snapshot': snapshot, 'pid': os.getpid()}
+    record.update(fields)
+    record['status'] = None
+    # Stages that overlap in one process (pipelined downloads and uploads) share the high water mark
+    peak_reset = reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    else:
+        if record['status'] is None:
+            record['status'] = 'ok'
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        if record.get('rows') and record['seconds']:
+            record['rows_per_sec'] = round(record['rows'] / record['seconds'], 1)
+        if record.get('bytes_in') and record['seconds']:
+            record['mb_per_sec'] = round(record['bytes_in'] / 2**20 / record['seconds'], 3)
+        peak = peak_rss_mb() if peak_reset else None
+        if peak is not None:
+            record['peak_rss_mb'] = peak
+        else:
+            # ru_maxrss is in KB on linux - the process's peak so far, not just this stage's
+            record['process_peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        try:
+            write_metric(record)
+        except OSError as e:
+            print('Metrics not written:', e)
+
+
+def file_size(path):
+    return os.path.getsize(path) if path and os.path.exists(path) else 0
+
+
+@contextlib.contextmanager
+def sampling_profiler(snapshot, interval=PROFILE_INTERVAL):
+    # Opt-in sampling profiler - a cpu timer signal records the current call stack, and the most frequent
+    # stacks are logged in collapsed (flame graph) form. Signals only reach the main thread, so it is skipped elsewhere
+    if not PROFILE_FACILITIES or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    samples = defaultdict(int)
+
+    def sample(signum, frame):
+        stack = []
+        while frame is not None and len(stack) < PROFILE_DEPTH:
+            stack.append('%s:%s:%s' % (frame.f_code.co_filename.split('/')[-1], frame.f_code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        samples[';'.join(reversed(stack))] += 1
+
+    previous = signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+        top = sorted(samples.items(), key=lambda item: -item[1])[:PROFILE_TOP]
+        write_metric({'time': datetime.now().isoformat(), 'stage': 'profile', 'snapshot': snapshot, 'pid': os.getpid(),
+                      'interval': interval, 'samples': sum(samples.values()), 'stacks': dict(top)})
+
+
+# ### Async s3 requests
+# * Many small requests (listings, existence checks, summary records) run concurrently instead of one round-trip at a time
+# * boto3 calls block, so each one runs on the event loop's thread pool, through the client's shared connection pool
+# * The synchronous pipeline calls in through run_async
+
+# In[8]:
+
+
+def run_async(job, *args, concurrency=S3_CONCURRENCY):
+    # Run job(semaphore, *args) to completion on a fresh event loop and return its result
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='s3'))
+        return await job(asyncio.Semaphore(concurrency), *args)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(main())
+    # A notebook kernel already runs an event loop on this thread, so the job gets a thread of its own
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(asyncio.run, main()).result()
+
+
+async def s3_call(semaphore, function, *args, **kwargs):
+    # One blocking s3 call on the loop's thread pool - the semaphore bounds the requests in flight
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+async def list_objects_async(semaphore, client, bucket, prefix=''):
+    # Objects under a prefix - the pages of one listing are fetched in order, separate listings overlap
+    pages = iter(client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix))
+    items = []
+    while True:
+        page = await s3_call(semaphore, next, pages, None)
+        if page is None:
+            return items
+        items.extend(page.get('Contents', []))
+
+
+async def list_many_async(semaphore, listings):
+    return await asyncio.gather(*[list_objects_async(semaphore, client, bucket, prefix) for client, bucket, prefix in listings])
+
+
+def list_objects_concurrent(listings):
+    # Object lists for [(client, bucket, prefix)], one list per listing in the same order
+    return run_async(list_many_async, listings)
+
+
+def object_exists(client, bucket, key):
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+async def exists_many_async(semaphore, client, pairs):
+    found = await asyncio.gather(*[s3_call(semaphore, object_exists, client, bucket, key) for bucket, key in pairs])
+    return dict(zip(pairs, found))
+
+
+def objects_exist(client, pairs):
+    # {(bucket, key): True/False} for [(bucket, key)], one head request each
+    return run_async(exists_many_async, client, pairs)
+
+
+def read_object(client, bucket, key):
+    return client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+async def read_many_async(semaphore, client, bucket, keys):
+    return await asyncio.gather(*[s3_call(semaphore, read_object, client, bucket, key) for key in keys])
+
+
+def read_objects(client, bucket, keys):
+    # Bodies of small objects, in the order of keys
+    return run_async(read_many_async, client, bucket, keys)
+
+
 # ### Step 1: Get new zip file from Yelp bucket and unzip
 
-# In[6]:
+# In[9]:
+
 
+def get_new_file(file, zip_file_path, json_file_path, decompress=True):
+    with stage('download', zip_file_path.split('/')[-1].split('_')[0], ranged=RANGED_DOWNLOADS, decompress=decompress) as record:
+        if RANGED_DOWNLOADS:
+            downloaded = get_new_file_ranged(file, zip_file_path, json_file_path, decompress)
+        else:
+            downloaded = fetch_new_file(file, zip_file_path, json_file_path, decompress)
+        record['status'] = 'ok' if downloaded else 'failed'
+        record['bytes_in'] = file_size(zip_file_path)
+        record['bytes_out'] = file_size(json_file_path) if decompress else 0
+        return downloaded
 
-def get_new_file(file, zip_file_path, json_file_path):
+
+def fetch_new_file(file, zip_file_path, json_file_path, decompress=True):
     
     # Upload files to zip path
     if os.path.exists(ZIP_PATH):
@@ -116,6 +448,14 @@ def get_new_file(file, zip_file_path, json_file_path):
         print('Zip path does not exist!' 'Please Create the appropriate directories.')
         return False
 
+    # Json is decoded straight from the zip file later on
+    if not decompress:
+        return True
+
+    return unzip_file(zip_file_path, json_file_path)
+
+
+def unzip_file(zip_file_path, json_file_path):
     # Unzip files to json path
     if os.path.exists(JSON_PATH):
         try:
@@ -133,14 +473,187 @@ def get_new_file(file, zip_file_path, json_file_path):
     return True
 
 
+# In[10]:
+
+
+class RangeReader:
+    # File-like reader over an s3 object - byte ranges are fetched on a thread pool and handed back in order
+    # Every byte read is also written to out and hashed, so the assembled file can be checked once it's all in
+    def __init__(self, client, bucket, key, size, out, range_size=DOWNLOAD_RANGE_SIZE, workers=DOWNLOAD_WORKERS):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.out = out
+        self.range_size = range_size
+        self.starts = iter(range(0, size, range_size))
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = deque()
+        self.chunk = b''
+        self.offset = 0
+        self.received = 0
+        self.md5 = hashlib.md5()
+        # Keep a window of ranges in flight ahead of the reader
+        for _ in range(2 * workers):
+            self.submit()
+
+    def submit(self):
+        start = next(self.starts, None)
+        if start is not None:
+            self.futures.append(self.pool.submit(self.fetch, start, min(start + self.range_size, self.size) - 1))
+
+    def fetch(self, start, end, attempts=3):
+        for attempt in range(attempts):
+            try:
+                body = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end))['Body'].read()
+                if len(body) == end - start + 1:
+                    return body
+                print('Short read on range', start, end, '- retrying')
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+        raise IOError('Range %d-%d of %s could not be downloaded' % (start, end, self.key))
+
+    def next_chunk(self):
+        if not self.futures:
+            return b''
+        chunk = self.futures.popleft().result()
+        self.submit()
+        self.out.write(chunk)
+        self.md5.update(chunk)
+        self.received += len(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.offset >= len(self.chunk):
+                self.chunk = self.next_chunk()
+                self.offset = 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            pieces.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(pieces)
+
+    def verify(self, etag):
+        # Drain whatever the reader hasn't consumed, then check the size and - for single part objects - the MD5 ETag
+        while self.next_chunk():
+            pass
+        if self.received != self.size:
+            raise IOError('Downloaded %d of %d bytes' % (self.received, self.size))
+        etag = etag.strip('"')
+        if '-' not in etag and self.md5.hexdigest() != etag:
+            raise IOError('Checksum mismatch for ' + self.key)
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        self.pool.shutdown(wait=True)
+
+
+def get_new_file_ranged(file, zip_file_path, json_file_path, decompress=True):
+    # Parallel ranged download of a snapshot - the json is unzipped from the incoming ranges as they arrive
+    if not os.path.exists(ZIP_PATH) or (decompress and not os.path.exists(JSON_PATH)):
+        print('Zip or JSON path does not exist!' 'Please Create the appropriate directories.')
+        return False
+    try:
+        print('Now downloading:', zip_file_path)
+        head = s3_yelp.head_object(Bucket=YELP_BUCKET, Key=file)
+        with open(zip_file_path, 'wb') as out:
+            reader = RangeReader(s3_yelp, YELP_BUCKET, file, head['ContentLength'], out)
+            try:
+                if decompress:
+                    print('Now unziping:', json_file_path)
+                    with gzip.GzipFile(fileobj=reader, mode='rb') as f_in:
+                        with open(json_file_path, 'wb') as f_out:
+                            shutil.copyfileobj(f_in, f_out, STREAM_CHUNK_SIZE)
+                reader.verify(head['ETag'])
+            finally:
+                reader.close()
+    except Exception as e:
+        print('There was a problem downloading the file:', zip_file_path, e)
+        for path in [zip_file_path, json_file_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+
+    return True
+
+
 # ### Step 2: Process JSON file
 
-# In[7]:
+# In[11]:
 
 
 NOT_WHITESPACE = re.compile(r'[^\s]')
 
-def decode_stacked(document, pos=0, decoder=JSONDecoder()):
+# Byte-oriented json parsers, fastest first - each takes one json document as bytes and raises a ValueError on bad input
+JSON_BACKENDS = {}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = orjson.loads
+
+
+def json_backend(backend=None):
+    # loads function of the selected backend, or None for the stdlib decoder
+    backend = backend or JSON_DECODER
+    if backend == 'stdlib':
+        return None
+    if backend == 'auto':
+        return next(iter(JSON_BACKENDS.values()), None)
+    if backend not in JSON_BACKENDS:
+        print(backend, 'is not installed - using the stdlib json decoder')
+        return None
+    return JSON_BACKENDS[backend]
+
+
+def extract_fields():
+    return 'summary' if SUMMARY_ONLY else EXTRACT_FIELDS
+
+
+def line_loads(backend=None):
+    # loads for decode_lines, or None to keep the stdlib text decoder - projections always take the byte path
+    loads = json_backend(backend)
+    if extract_fields() == 'all':
+        return loads
+    return skip_reviews(loads or json.loads)
+
+
+REVIEW_RATING = re.compile(rb'"rating":\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|null)')
+
+def skip_reviews(loads):
+    # loads for facility lines that never decodes the review bodies. When reviews is the facility's last member,
+    # as Yelp writes it, the array is cut out of the bytes and only each review's rating (all the summary
+    # needs) is picked out. Quotes inside json strings are escaped, so '"reviews":' only matches the key itself
+    def loads_projected(line):
+        start = line.rfind(b'"reviews":')
+        end = len(line.rstrip())
+        if start < 0 or line[end-2:end] != b']}':
+            return loads(line)
+        # Facilities stacked on one line leave more than one object before the cut - decode those in full
+        try:
+            fac = loads(line[:start] + b'"reviews": []}')
+        except ValueError:
+            return loads(line)
+        # Anything needed that came after the reviews would have been cut off with them
+        if not isinstance(fac, dict) or any(key not in fac for key in FACILITY_KEYS):
+            return loads(line)
+        fac['reviews'] = [{'rating': loads(value)} for value in REVIEW_RATING.findall(line, start, end)]
+        return fac
+    return loads_projected
+
+
+def decode_stacked(document, pos=0, decoder=JSONDecoder(), backend=None):
+    # Bytes are split into lines for a fast backend or a projection (the stdlib's json.loads if none is installed)
+    if isinstance(document, bytes):
+        f = io.BytesIO(document)
+        f.seek(pos)
+        yield from decode_lines(f, line_loads(backend) or json.loads, decoder=decoder)
+        return
+
     while True:
         match = NOT_WHITESPACE.search(document, pos)
         if not match:
@@ -155,125 +668,972 @@ def decode_stacked(document, pos=0, decoder=JSONDecoder()):
         yield obj
 
 
-# In[8]:
+# In[12]:
+
+
+def decode_stream(f, chunk_size=STREAM_CHUNK_SIZE, decoder=JSONDecoder(), state=None, backend=None):
+    # Stream version of decode_stacked: reads the file in fixed-size chunks and yields one object
+    # at a time, so only the unparsed tail of the file is ever held in memory
+    # If given, state is kept up to date at each object so stream_offset can tell where it ended
+    loads = line_loads(backend)
+    if loads is not None:
+        yield from decode_lines(f, loads, chunk_size, decoder, state)
+        return
+
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+    read = 0
+    if state is not None:
+        state['utf8'] = utf8
+    while True:
+        match = NOT_WHITESPACE.search(buffer, pos)
+        if match:
+            pos = match.start()
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except JSONDecodeError:
+                # Object runs past the end of the buffer - only an error if there is nothing left to read
+                if eof:
+                    raise
+            else:
+                if state is not None:
+                    state['buffer'], state['pos'], state['read'] = buffer, pos, read
+                yield obj
+                continue
+        elif eof:
+            return
+
+        # Drop the parsed text and read the next chunk (at least doubling for objects larger than a chunk)
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = f.read(max(chunk_size, len(buffer)))
+        if isinstance(chunk, bytes):
+            read += len(chunk)
+            chunk = utf8.decode(chunk, final=not chunk)
+        eof = not chunk
+        buffer += chunk
+
+
+def decode_lines(f, loads, chunk_size=STREAM_CHUNK_SIZE, decoder=JSONDecoder(), state=None):
+    # decode_stream for a byte-oriented backend - snapshots hold one object per line, so each line goes to loads
+    # whole and is never decoded to str. Anything else (an object spread over lines, several on a line, or json
+    # the backend rejects) gets the stdlib decoder on a window of text that doubles until the object fits
+    buffer = b''
+    pos = 0
+    eof = False
+    read = 0
+    window = 0
+    while True:
+        end = buffer.find(b'\n', pos)
+        if end == -1 and eof:
+            if pos >= len(buffer):
+                return
+            end = len(buffer)
+
+        if window:
+            final = eof and pos + window >= len(buffer)
+            text = codecs.getincrementaldecoder('utf-8')().decode(buffer[pos:pos+window], final=final)
+            try:
+                obj, end = decoder.raw_decode(text, len(text) - len(text.lstrip()))
+            except JSONDecodeError as e:
+                error = e
+                end = None
+            # An object that reaches the end of the text may be cut short by the window
+            if end is not None and (end < len(text) or final):
+                pos += len(text[:end].encode('utf-8'))
+                window = 0
+                if state is not None:
+                    state['buffer'], state['pos'], state['read'], state['utf8'] = buffer, pos, read, None
+                yield obj
+                continue
+            if pos + window < len(buffer):
+                window *= 2
+                continue
+            if eof:
+                raise error
+
+        elif end != -1:
+            line = buffer[pos:end]
+            if line and not line.isspace():
+                try:
+                    obj = loads(line)
+                except ValueError:
+                    window = STREAM_CHUNK_SIZE // 16
+                    continue
+                pos = min(end + 1, len(buffer))
+                if state is not None:
+                    state['buffer'], state['pos'], state['read'], state['utf8'] = buffer, pos, read, None
+                yield obj
+            else:
+                pos = end + 1
+            continue
+
+        # Drop the parsed bytes and read the next chunk (at least doubling for objects larger than a chunk)
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = f.read(max(chunk_size, len(buffer)))
+        read += len(chunk)
+        eof = not chunk
+        buffer += chunk
+
+
+def stream_offset(state):
+    # Bytes of the file consumed up to the end of the last object decode_stream yielded
+    # (bytes read, less the undecoded tail of the buffer and any partial character held by the utf-8 decoder)
+    if isinstance(state['buffer'], bytes):
+        return state['read'] - (len(state['buffer']) - state['pos'])
+    return state['read'] - len(state['buffer'][state['pos']:].encode('utf-8')) - len(state['utf8'].getstate()[0])
+
+
+# In[13]:
+
+
+class NumberColumn:
+    # Int64 buffer that switches to float64 on the first float or missing value - the same dtype pandas
+    # would infer from the row lists
+    def __init__(self):
+        self.values = array('q')
+        self.ints = True
+        self.nulls = 0
+
+    def to_floats(self):
+        if self.ints:
+            self.values = array('d', self.values)
+            self.ints = False
+
+    def extend_values(self, values):
+        if self.ints and set(map(type, values)) <= {int}:
+            self.values.extend(values)
+            return
+        self.to_floats()
+        nulls = values.count(None)
+        if nulls:
+            values = [math.nan if value is None else value for value in values]
+            self.nulls += nulls
+        self.values.extend(values)
+
+    def extend(self, other):
+        if not other.ints:
+            self.to_floats()
+        self.values.extend(other.values if self.ints or not other.ints else array('d', other.values))
+        self.nulls += other.nulls
+
+    def to_numpy(self):
+        return np.frombuffer(self.values, dtype=np.int64 if self.ints else np.float64)
+
+    def to_arrow(self):
+        return pa.array(self.to_numpy(), from_pandas=True)
+
+
+class BoolColumn:
+    # Int8 buffer of 0/1, with -1 for missing values
+    def __init__(self):
+        self.values = array('b')
+        self.nulls = 0
+
+    def extend_values(self, values):
+        nulls = values.count(None)
+        if nulls:
+            values = [-1 if value is None else value for value in values]
+            self.nulls += nulls
+        self.values.extend(values)
+
+    def extend(self, other):
+        self.values.extend(other.values)
+        self.nulls += other.nulls
+
+    def to_numpy(self):
+        values = np.frombuffer(self.values, dtype=np.int8)
+        if not self.nulls:
+            return values.view(np.bool_)
+        return pd.arrays.BooleanArray(values == 1, values < 0)
+
+    def to_arrow(self):
+        values = np.frombuffer(self.values, dtype=np.int8)
+        return pa.array(values == 1, mask=values < 0 if self.nulls else None)
+
+
+class DictionaryColumn:
+    # Repeated strings interned once, rows hold int32 codes (-1 for missing values)
+    def __init__(self):
+        self.index = {None: -1}
+        self.categories = []
+        self.codes = array('i')
+
+    def add_categories(self, values):
+        for value in values:
+            if value not in self.index:
+                self.index[value] = len(self.categories)
+                self.categories.append(value)
+
+    def extend_values(self, values):
+        self.add_categories(set(values).difference(self.index))
+        self.codes.extend(map(self.index.__getitem__, values))
+
+    def extend(self, other):
+        self.add_categories(other.categories)
+        mapping = np.array([self.index[value] for value in other.categories] + [-1], dtype=np.int32)
+        self.codes.frombytes(mapping[np.frombuffer(other.codes, dtype=np.int32)].tobytes())
+
+    def to_numpy(self):
+        return pd.Categorical.from_codes(np.frombuffer(self.codes, dtype=np.int32), categories=self.categories)
+
+    def to_arrow(self):
+        codes = np.frombuffer(self.codes, dtype=np.int32)
+        return pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                              pa.array([str(value) for value in self.categories], pa.string()))
+
+
+class StringColumn:
+    # Utf-8 bytes of every value packed into one buffer, with int64 end offsets and a validity flag per row
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+        self.valid = array('b')
+        self.nulls = 0
+
+    def extend_values(self, values):
+        nulls = values.count(None)
+        if nulls:
+            self.valid.extend([value is not None for value in values])
+            values = ['' if value is None else value for value in values]
+            self.nulls += nulls
+        else:
+            self.valid.extend(array('b', [1]) * len(values))
+        if set(map(type, values)) <= {str}:
+            encoded = list(map(str.encode, values))
+        else:
+            encoded = [str(value).encode('utf-8') for value in values]
+        self.offsets.extend(itertools.accumulate(map(len, encoded), initial=len(self.data)))
+        self.offsets.pop(-len(encoded)-1)
+        self.data += b''.join(encoded)
+
+    def extend(self, other):
+        offsets = np.frombuffer(other.offsets, dtype=np.int64)[1:] + len(self.data)
+        self.offsets.frombytes(offsets.tobytes())
+        self.data += other.data
+        self.valid.extend(other.valid)
+        self.nulls += other.nulls
+
+    def to_numpy(self):
+        # Arrow-backed pandas strings wrap the packed buffers - no python str is made for each value
+        if pa is not None:
+            try:
+                return pd.arrays.ArrowStringArray(self.string_array())
+            except (ValueError, TypeError): # older pandas only wraps 32-bit offset strings
+                pass
+        data = memoryview(self.data)
+        offsets = self.offsets
+        values = np.empty(len(self.valid), dtype=object)
+        for i, valid in enumerate(self.valid):
+            if valid:
+                values[i] = str(data[offsets[i]:offsets[i+1]], 'utf-8')
+        return values
+
+    def string_array(self):
+        validity = None
+        if self.nulls:
+            validity = pa.py_buffer(np.packbits(np.frombuffer(self.valid, dtype=np.uint8), bitorder='little'))
+        array = pa.LargeStringArray.from_buffers(len(self.valid), pa.py_buffer(self.offsets), pa.py_buffer(self.data),
+                                                 validity, self.nulls)
+        if len(self.data) < 2**31:
+            array = array.cast(pa.string())
+        return array
+
+    def to_arrow(self):
+        return self.string_array()
+
+
+class TimestampColumn(StringColumn):
+    # Times are kept as the original strings and only parsed for the columnar output
+    def to_arrow(self):
+        return pa.array(to_timestamp(pd.Series(self.to_numpy())), pa.timestamp('us', tz='UTC'))
+
+
+# In[14]:
+
+
+class ColumnBuilder:
+    # Accumulates master table rows into one typed, growable buffer per column instead of a python list per
+    # row. Appended rows are only held until the next flush, which transposes them into the buffers in C,
+    # and the buffers are handed to pandas or arrow without copying the numeric columns.
+    column_types = {'int': NumberColumn, 'float': NumberColumn, 'bool': BoolColumn,
+                    'dictionary': DictionaryColumn, 'string': StringColumn, 'timestamp': TimestampColumn}
+
+    def __init__(self, table):
+        self.table = table
+        self.names = [col for col, kind in MASTER_SCHEMAS[table]]
+        self.columns = [self.column_types[kind]() for col, kind in MASTER_SCHEMAS[table]]
+        self.rows = []
+        self.append = self.rows.append
+        self.length = 0
+
+    def __len__(self):
+        return self.length + len(self.rows)
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        del state['append']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.append = self.rows.append
+
+    def flush(self):
+        if self.rows:
+            for column, values in zip(self.columns, zip(*self.rows)):
+                column.extend_values(values)
+            self.length += len(self.rows)
+            self.rows.clear()
+
+    def extend(self, other):
+        self.flush()
+        other.flush()
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+        self.length += other.length
+
+    def to_pandas(self):
+        self.flush()
+        return pd.DataFrame({name: column.to_numpy() for name, column in zip(self.names, self.columns)},
+                            columns=self.names, copy=False)
+
+    def to_arrow(self):
+        self.flush()
+        data = pa.Table.from_arrays([column.to_arrow() for column in self.columns], names=self.names)
+        return data.cast(arrow_schema(self.table))
+
+
+def new_table(table):
+    if COLUMN_BUILDERS:
+        return ColumnBuilder(table)
+    return []
+
+
+def flush_tables(*tables):
+    for data in tables:
+        if isinstance(data, ColumnBuilder):
+            data.flush()
+
+
+def new_tables():
+    # Empty facility, category and review tables - None for the tables EXTRACT_FIELDS leaves out
+    return [new_table(table) if table in EXTRACT_TABLES[extract_fields()] else None
+            for table in ['facilities','categories','reviews']]
+
+
+def extend_tables(tables, others):
+    for data, other in zip(tables, others):
+        if data is not None:
+            data.extend(other)
+
+
+def to_frame(data, table):
+    if isinstance(data, ColumnBuilder):
+        return data.to_pandas()
+    return pd.DataFrame(data=data, columns=[col for col, kind in MASTER_SCHEMAS[table]])
+
+
+# In[15]:
+
+
+class SummaryAccumulator:
+    # Daily summary statistics updated one facility at a time, so the tables aren't needed to compute them
+    # Ratings and review counts are discrete, so exact value counts give the same means and medians as pandas
+    def __init__(self):
+        self.aliases = set()
+        self.fac_count = 0
+        self.fac_ratings = defaultdict(int)
+        self.review_counts = defaultdict(int)
+        self.rev_count = 0
+        self.rev_ratings = defaultdict(int)
+
+    def add(self, fac):
+        self.fac_count += 1
+        self.fac_ratings[fac['rating']] += 1
+        self.review_counts[fac['review_count']] += 1
+        for item in fac['categories']:
+            self.aliases.add(item['alias'])
+        for item in fac['reviews']:
+            self.rev_ratings[item['rating']] += 1
+        self.rev_count += len(fac['reviews'])
+
+    def merge(self, other):
+        self.aliases |= other.aliases
+        self.fac_count += other.fac_count
+        self.rev_count += other.rev_count
+        for counts, other_counts in [(self.fac_ratings, other.fac_ratings), (self.review_counts, other.review_counts),
+                                     (self.rev_ratings, other.rev_ratings)]:
+            for value, count in other_counts.items():
+                counts[value] += count
+
+    @staticmethod
+    def valid(counts):
+        # Value counts sorted by value, skipping missing values the way pandas does
+        return sorted((value, count) for value, count in counts.items() if value is not None and value == value)
+
+    @staticmethod
+    def mean(counts):
+        counts = SummaryAccumulator.valid(counts)
+        n = sum(count for value, count in counts)
+        if n == 0:
+            return np.nan
+        return float(sum(value * count for value, count in counts) / n)
+
+    @staticmethod
+    def median(counts):
+        counts = SummaryAccumulator.valid(counts)
+        n = sum(count for value, count in counts)
+        if n == 0:
+            return np.nan
+        # Values at the two middle positions - the same one when n is odd
+        middle = []
+        seen = 0
+        for value, count in counts:
+            seen += count
+            while len(middle) < 2 and seen > [(n - 1) // 2, n // 2][len(middle)]:
+                middle.append(float(value))
+        return (middle[0] + middle[1]) / 2
+
+    def summary(self, file_name):
+        # Row in the daily_data.csv column order
+        return [file_name, len(self.aliases),
+                self.fac_count, self.mean(self.fac_ratings), self.median(self.fac_ratings),
+                self.mean(self.review_counts), self.median(self.review_counts),
+                self.rev_count, self.mean(self.rev_ratings), self.median(self.rev_ratings)]
+
+
+# In[16]:
+
+
+def extract_facilities(facilities):
+    fac_data, cat_data, rev_data = new_tables()
+    summary = SummaryAccumulator()
+    count = 0
+
+    for fac in facilities:
+        summary.add(fac)
+        # Summary-only projection - every table is left out
+        if fac_data is None:
+            continue
+
+        # Facility data
+        fac_id = fac['id']
+        fac_name = fac['name']
+        fac_is_closed = fac['is_closed']
+        review_count = fac['review_count']
+        fac_rating = fac['rating']
+        fac_updated_time = fac['time_updated']
+        phone = fac['phone']
+        business_url = fac['business_url']
+        fac_url = fac['url']
+
+        # Facility data: location
+        address = ' '.join([item for item in fac['location']['address'] if item is not None]).strip()
+        city = fac['location']['city']
+        state = fac['location']['state']
+        country = fac['location']['country']
+        postal_code = fac['location']['postal_code']
+        latitude = fac['location']['coordinate']['latitude']
+        longitude = fac['location']['coordinate']['longitude']
+
+        fac_temp = [fac_id, fac_name, fac_is_closed, review_count, fac_rating, fac_updated_time, phone, business_url, 
+                    fac_url, address, city, state, country, postal_code, latitude, longitude]
+        fac_data.append(fac_temp)
+
+
+        # Categories
+        if cat_data is not None:
+            for item in fac['categories']:
+                cat_temp = [fac_id, item['alias'], item['title']]
+                cat_data.append(cat_temp) 
+
+
+        # Reviews
+        if rev_data is not None:
+            for item in fac['reviews']:
+                rev_id = item['id']
+                rev_rating = item['rating']
+                review = item['text']
+                user = item['user']['name']
+                rev_created_time = item['created']
+                rev_url = item['url']
+                rev_is_selected = item['is_selected']
+
+                rev_temp = [fac_id, rev_id, rev_rating, review, 
+                            user, rev_created_time, rev_url, rev_is_selected]
+                rev_data.append(rev_temp) 
+
+        if count % COLUMN_BATCH_ROWS == 0:
+            flush_tables(fac_data, cat_data, rev_data)
+        if count % 100000 == 0:
+            print(count, 'facilities processed...')
+        count += 1
+
+    return fac_data, cat_data, rev_data, summary
+
+
+def summarize_facilities(facilities):
+    # Summary statistics only - the facility rows are never kept
+    summary = SummaryAccumulator()
+    for fac in facilities:
+        summary.add(fac)
+        if summary.fac_count % 100000 == 0:
+            print(summary.fac_count, 'facilities processed...')
+    return summary
+
+
+# In[17]:
+
+
+FACILITY_START = re.compile(rb'\}\s*\{')
+
+def is_facility_start(mm, pos, decoder=JSONDecoder()):
+    # True if a complete facility object starts at pos and is followed by another object or the end of file
+    window = STREAM_CHUNK_SIZE
+    while True:
+        text = str(mm[pos:pos+window], 'utf-8', 'ignore')
+        try:
+            obj, end = decoder.raw_decode(text)
+        except JSONDecodeError:
+            obj = None
+        if obj is not None:
+            rest = text[end:].lstrip()
+            if rest or pos + window >= len(mm):
+                return isinstance(obj, dict) and 'location' in obj and (not rest or rest[0] == '{')
+        if pos + window >= len(mm):
+            return False
+        window *= 2
+
+
+def find_facility_boundaries(mm, parts):
+    # Split a memory-mapped stacked-json file into byte ranges that each start at a facility object.
+    # Between stacked objects '}' is followed by whitespace and '{', which valid json only allows inside
+    # strings - candidates are checked by decoding the object that starts there.
+    size = len(mm)
+    offsets = [0]
+    for i in range(1, parts):
+        pos = max(size * i // parts, offsets[-1] + 1)
+        while pos < size:
+            match = FACILITY_START.search(mm, pos)
+            if not match:
+                pos = size
+                break
+            pos = match.end() - 1
+            if is_facility_start(mm, pos):
+                break
+        if pos >= size:
+            break
+        offsets.append(pos)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+# In[18]:
+
+
+def extract_range(file, start, end, summary_only=False):
+    # Parse one byte range of a snapshot straight out of the memory map
+    with open(file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                # A fast backend or a projection parses the bytes as they are
+                if line_loads() is not None:
+                    document = bytes(view[start:end])
+                else:
+                    document = str(view[start:end], 'utf-8')
+            finally:
+                view.release()
+    if summary_only:
+        return None, None, None, summarize_facilities(decode_stacked(document))
+    return extract_facilities(decode_stacked(document))
+
+
+def extract_facilities_parallel(file, workers=PARSE_WORKERS, summary_only=False):
+    # Parse a snapshot as facility-aligned byte ranges on a process pool and merge the rows in file order
+    if os.path.getsize(file) == 0:
+        return new_tables() + [SummaryAccumulator()]
+    with open(file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = find_facility_boundaries(mm, workers * PARSE_RANGES_PER_WORKER)
+
+    tables = new_tables()
+    summary = SummaryAccumulator()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(extract_range, file, start, end, summary_only) for start, end in ranges]
+        for future in futures:
+            fac_temp, cat_temp, rev_temp, summary_temp = future.result()
+            summary.merge(summary_temp)
+            if not summary_only:
+                extend_tables(tables, [fac_temp, cat_temp, rev_temp])
+    print(summary.fac_count, 'facilities processed over', len(ranges), 'ranges')
+
+    return tables + [summary]
+
+
+# In[19]:
+
+
+def arrow_schema(table, columns=None):
+    types = {'string': pa.string(), 'dictionary': pa.dictionary(pa.int32(), pa.string()), 'bool': pa.bool_(),
+             'int': pa.int64(), 'float': pa.float64(), 'timestamp': pa.timestamp('us', tz='UTC')}
+    return pa.schema([(col, types[kind]) for col, kind in MASTER_SCHEMAS[table] if columns is None or col in columns])
+
+
+def to_timestamp(values):
+    # Yelp times are strings, but fall back to epoch seconds if a column comes through as numbers
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_datetime(values, errors='coerce', unit='s', utc=True)
+    return pd.to_datetime(values, errors='coerce', utc=True)
+
+
+def write_parquet(data, table, file_path, columns=None):
+    # Write a master table (or just the given columns) with its explicit schema (no pandas index column)
+    if pa is None:
+        print('pyarrow is not installed - skipping', file_path)
+        return False
+    if isinstance(data, ColumnBuilder):
+        data = data.to_arrow()
+        if columns is not None:
+            data = data.select(columns)
+    else:
+        data = to_frame(data, table)
+        if columns is not None:
+            data = data[columns]
+        for col, kind in MASTER_SCHEMAS[table]:
+            if kind == 'timestamp' and col in data:
+                data[col] = to_timestamp(data[col])
+        data = pa.Table.from_pandas(data, schema=arrow_schema(table, columns), preserve_index=False)
+    pq.write_table(data, file_path, compression=PARQUET_COMPRESSION)
+    return True
+
+
+# In[20]:
+
+
+# Each codec's output can be concatenated - gzip members, bz2 and xz streams all decompress back to back
+COMPRESSORS = {'gzip': lambda block, level: gzip.compress(block, compresslevel=level, mtime=0),
+               'bz2': lambda block, level: bz2.compress(block, level),
+               'xz': lambda block, level: lzma.compress(block, preset=level)}
+
+class CompressedWriter(io.RawIOBase):
+    # Binary file that cuts what is written into COMPRESSION_BLOCK_SIZE blocks and compresses each on a thread
+    # pool as an independent member, writing the members out in order. zlib, bz2 and lzma release the GIL, so
+    # the compression overlaps pandas formatting the next rows, and only a few blocks are held at once.
+    def __init__(self, file_path, codec, pool, level=None, block_size=None):
+        self.file = open(file_path, 'wb')
+        self.codec = codec
+        self.pool = pool
+        self.level = MASTER_COMPRESSION_LEVEL if level is None else level
+        self.block_size = COMPRESSION_BLOCK_SIZE if block_size is None else block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(COMPRESSORS[self.codec], block, self.level))
+        # Wait on the oldest block once every thread has a couple queued
+        while len(self.pending) > 2 * COMPRESSION_THREADS:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.file.close()
+            super().close()
+
+
+def master_csv(file_name, table):
+    return MASTER_PATH + file_name + '_' + table + CSV_EXTENSIONS[MASTER_COMPRESSION]
+
+
+def write_csv(data, file_path, pool=None):
+    # data.to_csv(file_path), streamed through the MASTER_COMPRESSION codec when one is set - decompressed, the
+    # output is byte for byte the plain csv. file_path carries the compressed extension (see master_csv).
+    if MASTER_COMPRESSION is None:
+        data.to_csv(file_path)
+        return
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS)
+    try:
+        with io.TextIOWrapper(CompressedWriter(file_path, MASTER_COMPRESSION, pool), encoding='utf-8', newline='') as f:
+            data.to_csv(f)
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+
+def content_args(file):
+    # Upload metadata of compressed csvs, so readers know to decompress them
+    encoding = CONTENT_ENCODINGS.get(os.path.splitext(file)[1])
+    if encoding is None or '.csv' not in file:
+        return {}
+    return {'ContentType': 'text/csv', 'ContentEncoding': encoding}
+
+
+# In[21]:
+
+
+def write_master_files(file_name, fac_data, cat_data, rev_data):
+    with stage('write', file_name, parquet=WRITE_PARQUET) as record:
+        record['rows'] = len(fac_data)
+        fac_data, cat_data, rev_data = write_master_tables(file_name, fac_data, cat_data, rev_data)
+        record['bytes_out'] = sum(file_size(file) for file in glob.glob(MASTER_PATH + file_name + '_*'))
+    return fac_data, cat_data, rev_data
+
+
+def write_master_tables(file_name, fac_data, cat_data, rev_data):
+    # Writing csv files...
+    print('Writing csv files...')
+
+    # Typed columnar copies - written first so column buffers go to arrow without a pandas round trip
+    # Tables left out by EXTRACT_FIELDS are None and aren't written
+    if WRITE_PARQUET:
+        write_parquet(fac_data, 'facilities', MASTER_PATH + file_name + '_facilities.parquet')
+        if cat_data is not None:
+            write_parquet(cat_data, 'categories', MASTER_PATH + file_name + '_categories.parquet')
+        if rev_data is not None:
+            write_parquet(rev_data, 'reviews', MASTER_PATH + file_name + '_reviews.parquet',
+                          REVIEW_REF_COLS if REVIEW_REFS_ONLY else None)
+        print('Parquet data created!')
+
+    # Write data to csv - compressed csvs share one pool of compression threads
+    with ThreadPoolExecutor(max_workers=COMPRESSION_THREADS) as pool:
+        fac_data = to_frame(fac_data, 'facilities')
+        write_csv(fac_data, master_csv(file_name, 'facilities'), pool)
+        print('Facility data created!')
+
+        if cat_data is not None:
+            cat_data = to_frame(cat_data, 'categories')
+            write_csv(cat_data, master_csv(file_name, 'categories'), pool)
+            print('Category data created!')
+
+        if rev_data is not None:
+            rev_data = to_frame(rev_data, 'reviews')
+            if REVIEW_REFS_ONLY:
+                write_csv(rev_data[REVIEW_REF_COLS], master_csv(file_name, 'reviews'), pool)
+            else:
+                write_csv(rev_data, master_csv(file_name, 'reviews'), pool)
+            print('Review data created!')
+
+    # Facility versions and review bodies are kept once across days
+    if UPDATE_FACILITY_STORE:
+        update_facility_store(file_name, fac_data)
+    if rev_data is not None and (UPDATE_REVIEW_STORE or REVIEW_REFS_ONLY):
+        update_review_store(file_name, rev_data)
+
+    return fac_data, cat_data, rev_data
+
+
+# In[22]:
+
+
+def extract_file(file_name, f, summary_rows=None, workers=1, summary_only=False):
+    print('Now processing:', file_name)
+    with stage('parse', file_name, workers=workers, summary_only=summary_only) as record:
+        with sampling_profiler(file_name):
+            if workers > 1:
+                fac_data, cat_data, rev_data, summary = extract_facilities_parallel(f.name, workers, summary_only)
+            elif summary_only:
+                summary = summarize_facilities(decode_stream(f))
+            else:
+                fac_data, cat_data, rev_data, summary = extract_facilities(decode_stream(f))
+        record['rows'] = summary.fac_count
+        record['reviews'] = summary.rev_count
+        record['bytes_in'] = file_size(getattr(f, 'name', None) if isinstance(getattr(f, 'name', None), str) else None)
+
+    if summary_only:
+        fac_data = cat_data = rev_data = None
+    return finish_file(file_name, fac_data, cat_data, rev_data, summary, summary_rows, summary_only)
+
+
+def finish_file(file_name, fac_data, cat_data, rev_data, summary, summary_rows=None, summary_only=False):
+    # Master files, summary row and deltas for a parsed snapshot - returns the summary row
+    if not summary_only:
+        fac_data, cat_data, rev_data = write_master_files(file_name, fac_data, cat_data, rev_data)
+
+    # Summary statistics were accumulated during the parse
+    print('Extracting summary data...')
+    summary_data = summary.summary(file_name)
+
+    # Summary history is either updated right away or collected by the caller (process pool workers)
+    # Summary store records are per date, so workers write their own
+    # A collected row is also kept on local disk until the history is uploaded, so it outlives a killed run
+    if summary_rows is None or SUMMARY_STORE:
+        update_summary([summary_data])
+    else:
+        save_pending_summary(summary_data)
+        summary_rows.append(summary_data)
+
+    # Changes against the previous snapshot
+    if WRITE_DELTAS and not summary_only:
+        tables = {'facilities': fac_data, 'categories': cat_data, 'reviews': rev_data}
+        write_deltas(file_name, {table: data for table, data in tables.items() if data is not None})
+
+    return summary_data
+
+
+# In[23]:
+
+
+def update_summary(summary_data):
+    with stage('summary', ','.join(str(row[0]) for row in summary_data), rows=len(summary_data), store=SUMMARY_STORE):
+        return write_summary_history(summary_data)
+
+
+def pending_summary_file(file_name):
+    return SUMMARY_PATH + str(file_name) + '_pending_summary.json'
+
+
+def save_pending_summary(summary_data):
+    # Written to a temporary file and moved into place, like the stage manifests
+    os.makedirs(SUMMARY_PATH, exist_ok=True)
+    with open(pending_summary_file(summary_data[0]) + '.tmp', 'w') as f:
+        json.dump(summary_data, f, default=str)
+    os.replace(pending_summary_file(summary_data[0]) + '.tmp', pending_summary_file(summary_data[0]))
+
+
+def load_pending_summaries():
+    # Summary rows collected by an earlier run that stopped before updating the history
+    summary_rows = []
+    for file in sorted(glob.glob(pending_summary_file('*'))):
+        with open(file) as f:
+            summary_rows.append(json.load(f))
+    return summary_rows
+
+
+def clear_pending_summaries(summary_rows):
+    for row in summary_rows:
+        if os.path.exists(pending_summary_file(row[0])):
+            os.remove(pending_summary_file(row[0]))
+
+
+def write_summary_history(summary_data):
+    # With the summary store, each date is written as its own record and the history isn't touched
+    if SUMMARY_STORE:
+        return write_summary_records(summary_data)
+
+    daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key='daily_data.csv')
+    daily_data = pd.read_csv(io.BytesIO(daily_data['Body'].read()), index_col=0)
+    # Each row keeps the 0 index it would get if the snapshots were added one at a time
+    summary_data = pd.DataFrame(summary_data, columns=SUMMARY_COLS, index=[0]*len(summary_data))
+    summary_data = summary_data[~summary_data['date'].isin(daily_data['date'])]
+    history_len = len(daily_data)
+    daily_data = pd.concat([daily_data,summary_data])
+    daily_data.to_csv(SUMMARY_PATH + 'daily_data.csv')
+
+    # Dated copies hold the history as of each new date
+    for i, file_name in enumerate(summary_data['date']):
+        daily_data.iloc[:history_len+i+1].to_csv(SUMMARY_PATH + file_name + '_daily_data.csv')
+    print('Summary data created!')
+    
+    del daily_data
+    del summary_data
+
 
+# In[24]:
 
-def extract_data():
-    for file in glob.glob(JSON_PATH + '*.json'):
+
+def write_summary_records(summary_data):
+    # One small csv per date in the auxiliary bucket - rewriting a date just replaces its record
+    for row in summary_data:
+        record = pd.DataFrame([row], columns=SUMMARY_COLS, index=[0])
+        s3_cdh.put_object(Bucket=CDH_BUCKET_AUX, Key=SUMMARY_RECORD_PREFIX + str(row[0]) + '.csv',
+                          Body=record.to_csv().encode('utf-8'))
+    print('Summary records created!')
+    return True
+
+
+def read_daily_data():
+    # Compacted summary history
+    daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key='daily_data.csv')
+    return pd.read_csv(io.BytesIO(daily_data['Body'].read()), index_col=0)
+
+
+def read_summary_records(exclude=()):
+    # Summary records in date order, skipping dates in exclude (already compacted)
+    keys = list_bucket_keys(s3_cdh, CDH_BUCKET_AUX, SUMMARY_RECORD_PREFIX)
+    dates = sorted(key[len(SUMMARY_RECORD_PREFIX):].split('.csv')[0] for key in keys if key.endswith('.csv'))
+    keys = [SUMMARY_RECORD_PREFIX + date + '.csv' for date in dates if int(date) not in exclude]
+    if ASYNC_S3:
+        bodies = read_objects(s3_cdh, CDH_BUCKET_AUX, keys)
+    else:
+        bodies = [read_object(s3_cdh, CDH_BUCKET_AUX, key) for key in keys]
+    records = [pd.read_csv(io.BytesIO(body), index_col=0) for body in bodies]
+    if not records:
+        return pd.DataFrame(columns=SUMMARY_COLS)
+    return pd.concat(records)
+
+
+def compact_summaries():
+    # Fold summary records not yet in daily_data.csv into it, along with a dated copy for each new date
+    # Records stay in place, so a compaction lost to a concurrent run is picked up by the next one
+    daily_data = read_daily_data()
+    records = read_summary_records(exclude=set(daily_data['date']))
+    if len(records) == 0:
+        print('No summary records to compact.')
+        return True
+
+    history_len = len(daily_data)
+    daily_data = pd.concat([daily_data, records])
+    daily_data.to_csv(SUMMARY_PATH + 'daily_data.csv')
+    for i, file_name in enumerate(records['date']):
+        daily_data.iloc[:history_len+i+1].to_csv(SUMMARY_PATH + str(file_name) + '_daily_data.csv')
+    print(len(records), 'summary records compacted!')
+
+    return save_files(names=['daily_data.csv'] + [str(file_name)+'_daily_data.csv' for file_name in records['date']])
+
+
+def read_summaries(start_date, end_date=None):
+    # Summary rows for dates from start_date to end_date (inclusive), including records not compacted yet
+    daily_data = read_daily_data()
+    records = read_summary_records(exclude=set(daily_data['date']))
+    if len(records):
+        daily_data = pd.concat([daily_data, records])
+    daily_data = daily_data.sort_values('date', kind='mergesort')
+    dates = daily_data['date'].astype('int64').values
+    start = np.searchsorted(dates, int(start_date), side='left')
+    end = len(dates) if end_date is None else np.searchsorted(dates, int(end_date), side='right')
+    return daily_data.iloc[start:end]
+
+
+# In[25]:
+
+
+def extract_data(files=None, summary_rows=None, workers=None):
+    if files is None:
+        files = glob.glob(JSON_PATH + '*.json')
+    if workers is None:
+        workers = PARSE_WORKERS
+    for file in files:
         file_name = file.split('/')[-1].split('_')[0]
-        if os.path.exists(MASTER_PATH) and (MASTER_PATH+file_name+'_facilities.csv') not in glob.glob(MASTER_PATH+'*.csv'):
+        if os.path.exists(MASTER_PATH) and master_csv(file_name, 'facilities') not in glob.glob(MASTER_PATH+'*.csv*'):
             try:
                 print('Now reading:', file)
-                with open(file,'r') as f:
-                    data = f.read()
-                print('Now processing:', file)
-
-                fac_data = []
-                cat_data = []
-                rev_data = []
-                summary_data = []
-                count = 0
-
-                for fac in decode_stacked(data):
-
-                    # Facility data
-                    fac_id = fac['id']
-                    fac_name = fac['name']
-                    fac_is_closed = fac['is_closed']
-                    review_count = fac['review_count']
-                    fac_rating = fac['rating']
-                    fac_updated_time = fac['time_updated']
-                    phone = fac['phone']
-                    business_url = fac['business_url']
-                    fac_url = fac['url']
-
-                    # Facility data: location
-                    address = ' '.join([item for item in fac['location']['address'] if item is not None]).strip()
-                    city = fac['location']['city']
-                    state = fac['location']['state']
-                    country = fac['location']['country']
-                    postal_code = fac['location']['postal_code']
-                    latitude = fac['location']['coordinate']['latitude']
-                    longitude = fac['location']['coordinate']['longitude']
-
-                    fac_temp = [fac_id, fac_name, fac_is_closed, review_count, fac_rating, fac_updated_time, phone, business_url, 
-                                fac_url, address, city, state, country, postal_code, latitude, longitude]
-                    fac_data.append(fac_temp)
-
-
-                    # Categories
-                    for item in fac['categories']:
-                        cat_temp = [fac_id, item['alias'], item['title']]
-                        cat_data.append(cat_temp) 
-
-
-                    # Reviews
-                    for item in fac['reviews']:
-                        rev_id = item['id']
-                        rev_rating = item['rating']
-                        review = item['text']
-                        user = item['user']['name']
-                        rev_created_time = item['created']
-                        rev_url = item['url']
-                        rev_is_selected = item['is_selected']
-
-                        rev_temp = [fac_id, rev_id, rev_rating, review, 
-                                    user, rev_created_time, rev_url, rev_is_selected]
-                        rev_data.append(rev_temp) 
-
-                    if count % 100000 == 0:
-                        print(count, 'facilities processed...')
-                    count += 1
-
-                # Writing csv files...
-                del data
-                print('Writing csv files...')
-
-                # Write data to csv
-                fac_cols = ['fac_id','fac_name','fac_is_closed','review_count','fac_rating','fac_updated_time','phone',
-                            'business_url','fac_url','address','city','state','country','postal_code','latitude','longitude']
-                fac_data = pd.DataFrame(data=fac_data, columns=fac_cols)
-                fac_data.to_csv(MASTER_PATH + file_name + '_facilities.csv')
-                print('Facility data created!')
-
-                cat_cols = ['fac_id','alias','title']
-                cat_data = pd.DataFrame(data=cat_data, columns=cat_cols)
-                cat_data.to_csv(MASTER_PATH + file_name + '_categories.csv')
-                print('Category data created!')
-
-                rev_cols = ['fac_id', 'rev_id', 'rev_rating', 'review', 
-                            'user', 'rev_created_time', 'rev_url', 'rev_is_selected']
-                rev_data = pd.DataFrame(data=rev_data, columns=rev_cols)
-                rev_data.to_csv(MASTER_PATH + file_name + '_reviews.csv')
-                print('Review data created!')
-                
-                # Extract summary data
-                print('Extracting summary data...')
-                daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key='daily_data.csv')
-                daily_data = pd.read_csv(io.BytesIO(daily_data['Body'].read()), index_col=0)
-                summary_data.append([file_name, len(cat_data.alias.unique()),
-                                     len(fac_data), fac_data['fac_rating'].mean(), fac_data['fac_rating'].median(),
-                                     fac_data['review_count'].mean(), fac_data['review_count'].median(),
-                                     len(rev_data), rev_data['rev_rating'].mean(), rev_data['rev_rating'].median()])
-                summary_cols = ['date','cat_count',
-                                'fac_count','fac_rating_mean','fac_rating_med',
-                                'fac_rev_count_mean','fac_rev_count_med',
-                                'rev_count','rev_rating_mean','rev_rating_med']
-                summary_data = pd.DataFrame(summary_data, columns=summary_cols)
-                summary_data = summary_data[~summary_data['date'].isin(daily_data['date'])]
-                daily_data = pd.concat([daily_data,summary_data])
-                daily_data.to_csv(SUMMARY_PATH + 'daily_data.csv')
-                daily_data.to_csv(SUMMARY_PATH + file_name + '_daily_data.csv')
-                print('Summary data created!')
-                
-                # Delete temporary data
-                print('Removing temporary files...')
-                del fac_data
-                del cat_data
-                del rev_data
-                del daily_data
-                del summary_data
-                
+                with open(file,'rb') as f:
+                    extract_file(file_name, f, summary_rows, workers=workers, summary_only=extract_fields() == 'summary')
             except:
                 print('Data extraction failed! Please retry.')
                 return False
@@ -281,21 +1641,550 @@ def extract_data():
     return True
 
 
+# In[26]:
+
+
+class TeeReader:
+    # File-like wrapper that copies everything read from f into out
+    def __init__(self, f, out):
+        self.f = f
+        self.out = out
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.out.write(chunk)
+        return chunk
+
+
+def extract_zip_data(zip_file_path, json_file_path, archive_json=ARCHIVE_JSON, summary_rows=None):
+    # Parse straight off the gzip stream - the json archive copy is written in the same pass, or skipped
+    file_name = json_file_path.split('/')[-1].split('_')[0]
+    if os.path.exists(MASTER_PATH) and master_csv(file_name, 'facilities') not in glob.glob(MASTER_PATH+'*.csv*'):
+        try:
+            print('Now reading:', zip_file_path)
+            with gzip.open(zip_file_path, 'rb') as f:
+                if archive_json:
+                    with open(json_file_path, 'wb') as out:
+                        extract_file(file_name, TeeReader(f, out), summary_rows, summary_only=extract_fields() == 'summary')
+                else:
+                    extract_file(file_name, f, summary_rows, summary_only=extract_fields() == 'summary')
+        except:
+            print('Data extraction failed! Please retry.')
+            if os.path.exists(json_file_path):
+                os.remove(json_file_path)
+            return False
+
+    return True
+
+
+# In[27]:
+
+
+def open_store(name):
+    # Connect to a local store database, restoring it from the auxiliary bucket if it isn't on this machine
+    os.makedirs(STORE_PATH, exist_ok=True)
+    local_file = STORE_PATH + name
+    if not os.path.exists(local_file):
+        # Downloaded beside the store and linked into place - linking fails if another process restored it first
+        tmp_file = local_file + '.' + str(os.getpid()) + '.tmp'
+        try:
+            s3_cdh.download_file(Bucket=CDH_BUCKET_AUX, Key='stores/' + name, Filename=tmp_file)
+            os.link(tmp_file, local_file)
+            mark_backed_up(name)
+            print('Store restored from s3:', name)
+        except ClientError:
+            print('Starting a new store:', name)
+        except FileExistsError:
+            pass
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return sqlite3.connect(local_file, timeout=600)
+
+
+def restore_stores():
+    # Stores this run writes to are restored before a process pool forks, so workers don't each download them
+    names = [REVIEW_STORE_NAME] if UPDATE_REVIEW_STORE or REVIEW_REFS_ONLY else []
+    if UPDATE_FACILITY_STORE:
+        names.append(FACILITY_STORE_NAME)
+    for name in names:
+        open_store(name).close()
+
+
+def mark_backed_up(name):
+    # The modification time of the store as it was last copied to s3
+    with open(STORE_PATH + name + '.backup', 'w') as f:
+        f.write(str(os.stat(STORE_PATH + name).st_mtime_ns))
+
+
+def backed_up(name):
+    if not os.path.exists(STORE_PATH + name + '.backup'):
+        return False
+    with open(STORE_PATH + name + '.backup') as f:
+        return f.read() == str(os.stat(STORE_PATH + name).st_mtime_ns)
+
+
+def backup_store(name):
+    # Copy a store database to the auxiliary bucket if it changed since its last backup. The write lock is
+    # held during the upload, so the copy is consistent and no other process changes the store meanwhile.
+    con = sqlite3.connect(STORE_PATH + name, timeout=600)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        # Reading rolls back a hot journal left by a crashed writer before the file is copied
+        con.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        if backed_up(name):
+            return True
+        args_dict = dict()
+        args_dict['StorageClass'] = 'STANDARD'
+        if not upload_to_aws(STORE_PATH + name, CDH_BUCKET_AUX, 'stores/' + name, args_dict, overwrite=True):
+            return False
+        mark_backed_up(name)
+        return True
+    finally:
+        con.rollback()
+        con.close()
+
+
+def backup_stores(names=None):
+    # Copy the local store databases that changed to the auxiliary bucket
+    if names is None:
+        names = [file.split(STORE_PATH)[-1] for file in glob.glob(STORE_PATH + '*.db')]
+    for name in names:
+        if os.path.exists(STORE_PATH + name) and not backup_store(name):
+            return False
+    return True
+
+
+def save_stores():
+    # Stores go to s3 once per run. Ref-only daily review files point at bodies in the review store,
+    # so they are held back by save_files until it has been backed up.
+    if not backup_stores():
+        print('The stores could not be backed up!')
+        return False
+    if REVIEW_REFS_ONLY:
+        names = [file.split(MASTER_PATH)[-1] for file in master_files(hold_reviews=False) if is_review_file(file)]
+        if names and not save_files(names=names, hold_reviews=False):
+            print('There was a problem saving the review files!')
+            return False
+    return True
+
+
+# In[28]:
+
+
+def update_review_store(file_name, rev_data):
+    # Keep each review body once, recording the facility and the first and last snapshot it was seen in
+    con = open_store(REVIEW_STORE_NAME)
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS reviews (
+                       rev_id TEXT PRIMARY KEY, fac_id TEXT, rev_rating INTEGER, review TEXT, user TEXT,
+                       rev_created_time TEXT, rev_url TEXT, first_seen TEXT, last_seen TEXT)""")
+        con.execute('CREATE INDEX IF NOT EXISTS reviews_first_seen ON reviews (first_seen)')
+        con.execute('CREATE INDEX IF NOT EXISTS reviews_last_seen ON reviews (last_seen)')
+        con.execute('CREATE INDEX IF NOT EXISTS reviews_fac_id ON reviews (fac_id)')
+
+        cols = ['rev_id','fac_id','rev_rating','review','user','rev_created_time','rev_url']
+        rows = rev_data[cols].astype(object)
+        rows = rows.where(rows.notna(), None)
+        con.executemany("""INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT (rev_id) DO UPDATE SET
+                           first_seen = min(first_seen, excluded.first_seen),
+                           last_seen = max(last_seen, excluded.last_seen)""",
+                        (row + (file_name, file_name) for row in rows.itertuples(index=False, name=None)))
+    con.close()
+    print('Review store updated!')
+
+
+def query_review_store(sql, params=()):
+    con = open_store(REVIEW_STORE_NAME)
+    data = pd.read_sql_query(sql, con, params=params)
+    con.close()
+    return data
+
+
+def get_new_reviews(start_date, end_date=None):
+    # Reviews first seen between two snapshot dates (YYYYMMDD, inclusive)
+    return query_review_store('SELECT * FROM reviews WHERE first_seen >= ? AND first_seen <= ? ORDER BY first_seen',
+                              (start_date, end_date or '99999999'))
+
+
+def get_reviews(rev_ids):
+    # Full review records for rev_ids referenced by the daily review files
+    rev_ids = list(rev_ids)
+    data = [query_review_store('SELECT * FROM reviews WHERE rev_id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for chunk in [rev_ids[i:i+500] for i in range(0, len(rev_ids), 500)]]
+    return pd.concat(data, ignore_index=True) if data else pd.DataFrame()
+
+
+# In[29]:
+
+
+def create_facility_store(con):
+    # One row per facility version - valid_from and valid_to are the first and last snapshot it was seen in,
+    # and a version was seen in every snapshot in between. The snapshots table lists the dates loaded.
+    columns = ', '.join(col + ' ' + STORE_TYPES[kind] for col, kind in MASTER_SCHEMAS['facilities'])
+    con.execute('CREATE TABLE IF NOT EXISTS facilities (%s, valid_from TEXT, valid_to TEXT)' % columns)
+    con.execute('CREATE TABLE IF NOT EXISTS snapshots (date TEXT PRIMARY KEY, facilities INTEGER)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_fac_id ON facilities (fac_id, valid_from)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_valid_from ON facilities (valid_from)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_valid_to ON facilities (valid_to)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_location ON facilities (state, city)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_postal_code ON facilities (postal_code)')
+    con.execute('CREATE INDEX IF NOT EXISTS facilities_fac_rating ON facilities (fac_rating)')
+
+
+def append_facility_snapshot(con, file_name, rows, previous):
+    # Extend the versions seen unchanged since the previous snapshot and start new ones for the rest
+    cols = [col for col, kind in MASTER_SCHEMAS['facilities']]
+    columns = ', '.join(col + ' ' + STORE_TYPES[kind] for col, kind in MASTER_SCHEMAS['facilities'])
+    con.execute('DROP TABLE IF EXISTS temp.snapshot')
+    con.execute('CREATE TEMP TABLE snapshot (%s, PRIMARY KEY (fac_id))' % columns)
+    con.executemany('INSERT INTO snapshot VALUES (%s)' % ', '.join('?' * len(cols)), rows)
+
+    if previous is not None:
+        # IS compares missing values as equal
+        same = ' AND '.join('s.%s IS facilities.%s' % (col, col) for col in cols)
+        con.execute('UPDATE facilities SET valid_to = ? WHERE valid_to = ? AND EXISTS (SELECT 1 FROM snapshot s WHERE %s)' % same,
+                    (file_name, previous))
+    con.execute("""INSERT INTO facilities SELECT *, ?, ? FROM snapshot s
+                   WHERE NOT EXISTS (SELECT 1 FROM facilities f WHERE f.fac_id = s.fac_id AND f.valid_to = ?)""",
+                (file_name, file_name, file_name))
+    con.execute('INSERT INTO snapshots VALUES (?, ?)', (file_name, len(rows)))
+    con.execute('DROP TABLE temp.snapshot')
+
+
+def update_facility_store(file_name, fac_data):
+    # Add a snapshot's facilities to the facility store - duplicate fac_ids keep their last row, as in the deltas.
+    # Snapshots processed out of order (by a process pool) are slotted in by rolling back the later dates,
+    # which are read back from the store itself, and appending them again after this one.
+    rows = fac_data.drop_duplicates('fac_id', keep='last').astype(object)
+    rows = list(rows.where(rows.notna(), None).itertuples(index=False, name=None))
+
+    cols = ', '.join(col for col, kind in MASTER_SCHEMAS['facilities'])
+    con = open_store(FACILITY_STORE_NAME)
+    # Taking the write lock up front keeps concurrent workers from interleaving their updates
+    con.execute('BEGIN IMMEDIATE')
+    with con:
+        create_facility_store(con)
+        if con.execute('SELECT 1 FROM snapshots WHERE date = ?', (file_name,)).fetchone():
+            print('Facility store already has', file_name)
+        else:
+            later = [date for date, in con.execute('SELECT date FROM snapshots WHERE date > ? ORDER BY date', (file_name,))]
+            replay = [(date, con.execute('SELECT %s FROM facilities WHERE valid_from <= ? AND valid_to >= ?' % cols,
+                                         (date, date)).fetchall()) for date in later]
+            previous = con.execute('SELECT max(date) FROM snapshots WHERE date < ?', (file_name,)).fetchone()[0]
+            if later:
+                con.execute('DELETE FROM facilities WHERE valid_from > ?', (file_name,))
+                con.execute('UPDATE facilities SET valid_to = ? WHERE valid_to > ?', (previous, file_name))
+                con.execute('DELETE FROM snapshots WHERE date > ?', (file_name,))
+
+            append_facility_snapshot(con, file_name, rows, previous)
+            previous = file_name
+            for date, date_rows in replay:
+                append_facility_snapshot(con, date, date_rows, previous)
+                previous = date
+    con.close()
+    print('Facility store updated!')
+
+
+def query_facility_store(sql, params=()):
+    con = open_store(FACILITY_STORE_NAME)
+    data = pd.read_sql_query(sql, con, params=params)
+    con.close()
+    return data
+
+
+def get_facility(fac_id, date=None):
+    # Every stored version of a facility in date order, or just the one seen in the snapshot of date (YYYYMMDD)
+    if date is None:
+        return query_facility_store('SELECT * FROM facilities WHERE fac_id = ? ORDER BY valid_from', (fac_id,))
+    return query_facility_store('SELECT * FROM facilities WHERE fac_id = ? AND valid_from <= ? AND valid_to >= ?',
+                                (fac_id, date, date))
+
+
+def get_facilities(start_date, end_date=None, state=None, city=None, postal_code=None, min_rating=None, max_rating=None):
+    # Facility versions seen between two snapshot dates (inclusive - just start_date if end_date is None),
+    # optionally only those in a state/city/postal code or with a rating in a range
+    where = ['valid_from <= ?', 'valid_to >= ?']
+    params = [end_date or start_date, start_date]
+    for col, value in [('state', state), ('city', city), ('postal_code', postal_code)]:
+        if value is not None:
+            where.append(col + ' = ?')
+            params.append(value)
+    if min_rating is not None:
+        where.append('fac_rating >= ?')
+        params.append(min_rating)
+    if max_rating is not None:
+        where.append('fac_rating <= ?')
+        params.append(max_rating)
+    return query_facility_store('SELECT * FROM facilities WHERE %s ORDER BY fac_id, valid_from' % ' AND '.join(where), params)
+
+
+# In[30]:
+
+
+def compute_delta(previous, current, keys):
+    # Records added, removed (keys only) and changed between two versions of a master table.
+    # Tables are compared as sets of records keyed by keys - duplicate keys keep their last row.
+    previous = previous.astype({key: object for key in keys}).drop_duplicates(keys, keep='last').set_index(keys)
+    current = current.astype({key: object for key in keys}).drop_duplicates(keys, keep='last').set_index(keys)
+
+    added = current[~current.index.isin(previous.index)]
+    removed = previous.index.difference(current.index).to_frame(index=False)
+
+    common = current.index.intersection(previous.index)
+    new = current.loc[common].astype(object)
+    old = previous.loc[common, current.columns].astype(object)
+    same = (new == old) | (new.isna() & old.isna())
+    changed = current.loc[common][~same.all(axis=1).values]
+
+    return added.reset_index(), removed, changed.reset_index()
+
+
+def write_deltas(file_name, tables):
+    # Write <date>_<table>_added/removed/changed.csv and <date>_delta_manifest.json to MASTER_PATH, using the
+    # previous day's full tables kept in DELTA_PATH. Every DELTA_BASE_INTERVAL days the snapshot becomes a
+    # new base, and with DELTA_ONLY_UPLOADS the full master files are only kept on base days.
+    os.makedirs(DELTA_PATH, exist_ok=True)
+    state_file = DELTA_PATH + 'delta_state.json'
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    date = datetime.strptime(file_name, '%Y%m%d')
+    is_base = state is None or (date - datetime.strptime(state['base'], '%Y%m%d')).days >= DELTA_BASE_INTERVAL
+    manifest = {'date': file_name, 'previous': state['date'] if state else None,
+                'base': file_name if is_base else state['base'], 'is_base': is_base,
+                'extension': CSV_EXTENSIONS[MASTER_COMPRESSION], 'tables': {}}
+
+    for table, data in tables.items():
+        counts = {'rows': len(data)}
+        if state is not None:
+            previous = pd.read_pickle(DELTA_PATH + table + '.pkl')
+            added, removed, changed = compute_delta(previous, data, DELTA_KEYS[table])
+            write_csv(added, master_csv(file_name, table + '_added'))
+            write_csv(removed, master_csv(file_name, table + '_removed'))
+            write_csv(changed, master_csv(file_name, table + '_changed'))
+            counts.update(added=len(added), removed=len(removed), changed=len(changed))
+            del previous
+        manifest['tables'][table] = counts
+        data.to_pickle(DELTA_PATH + table + '.pkl')
+
+    with open(MASTER_PATH + file_name + '_delta_manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    with open(state_file, 'w') as f:
+        json.dump({'date': file_name, 'base': manifest['base']}, f)
+
+    if DELTA_ONLY_UPLOADS and not is_base:
+        for table in tables:
+            for ext in ['.csv', CSV_EXTENSIONS[MASTER_COMPRESSION], '.parquet']:
+                if os.path.exists(MASTER_PATH + file_name + '_' + table + ext):
+                    os.remove(MASTER_PATH + file_name + '_' + table + ext)
+    print('Delta files created!', 'New base:' if is_base else 'Base:', manifest['base'])
+
+
+# In[31]:
+
+
+def read_master_file(key, bucket=CDH_BUCKET_MASTER):
+    obj = s3_cdh.get_object(Bucket=bucket, Key=key)
+    if key.endswith('.json'):
+        return json.loads(obj['Body'].read())
+    compression = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}.get(os.path.splitext(key)[1])
+    return pd.read_csv(io.BytesIO(obj['Body'].read()), index_col=0, compression=compression)
+
+
+def rebuild_table(file_name, table, bucket=CDH_BUCKET_MASTER):
+    # Rebuild a day's full master table from its base snapshot and the deltas since. Records come back in
+    # base order with changed and added records at the end, not in the order of the original file.
+    # Each day's csvs carry the extension its manifest records - older manifests predate compression
+    manifest = read_master_file(file_name + '_delta_manifest.json', bucket)
+    chain = []
+    while not manifest['is_base']:
+        chain.append((manifest['date'], manifest.get('extension', '.csv')))
+        manifest = read_master_file(manifest['previous'] + '_delta_manifest.json', bucket)
+
+    data = read_master_file(manifest['date'] + '_' + table + manifest.get('extension', '.csv'), bucket)
+    columns = data.columns
+    keys = DELTA_KEYS[table]
+    for date, ext in reversed(chain):
+        added = read_master_file(date + '_' + table + '_added' + ext, bucket)
+        removed = read_master_file(date + '_' + table + '_removed' + ext, bucket)
+        changed = read_master_file(date + '_' + table + '_changed' + ext, bucket)
+        data = data.set_index(keys)
+        dropped = removed.set_index(keys).index.union(changed.set_index(keys).index)
+        data = pd.concat([data[~data.index.isin(dropped)].reset_index(), changed, added], ignore_index=True)
+        data = data[columns]
+
+    return data
+
+
 # ### Step 3: Upload files to s3 and remove from directories
 
-# In[9]:
+# In[32]:
+
+
+# Keys in each CDH bucket, listed once per run
+bucket_keys = {}
+# Keys a batch check found missing, so key_exists doesn't ask s3 again right before the upload
+absent_keys = defaultdict(set)
+index_lock = threading.RLock()
+
+def list_bucket_objects(client, bucket, prefix=''):
+    # Every object in a bucket, following list_objects_v2 pagination past 1,000 keys
+    items = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        items.extend(page.get('Contents', []))
+    return items
+
+
+def list_bucket_keys(client, bucket, prefix=''):
+    return [item['Key'] for item in list_bucket_objects(client, bucket, prefix)]
+
+
+def get_key_index(bucket):
+    # Key set for a bucket - built with one paginated listing per run, or from its archive-id manifest
+    with index_lock:
+        if bucket not in bucket_keys:
+            if ARCHIVE_MANIFEST and bucket in ARCHIVE_MANIFESTS:
+                store_key_index(bucket, read_archive_manifest(bucket))
+            else:
+                print('Indexing bucket:', bucket)
+                store_key_index(bucket, list_bucket_keys(s3_cdh, bucket))
+        return bucket_keys[bucket]
+
+
+def store_key_index(bucket, keys):
+    bucket_keys[bucket] = set(keys)
+
+
+def build_key_indexes(buckets):
+    # Index several buckets up front - with ASYNC_S3 their listings run at the same time
+    with index_lock:
+        buckets = [bucket for bucket in buckets if bucket not in bucket_keys]
+        listed = [bucket for bucket in buckets if not (ARCHIVE_MANIFEST and bucket in ARCHIVE_MANIFESTS)]
+        if ASYNC_S3 and listed:
+            print('Indexing buckets:', ', '.join(listed))
+            listings = list_objects_concurrent([(s3_cdh, bucket, '') for bucket in listed])
+            for bucket, items in zip(listed, listings):
+                store_key_index(bucket, [item['Key'] for item in items])
+        for bucket in buckets:
+            get_key_index(bucket)
+
+
+def add_key(bucket, key):
+    # Record a completed upload in the bucket's index - a bucket that isn't indexed yet isn't listed just for this
+    with index_lock:
+        keys = bucket_keys.get(bucket)
+        if keys is not None:
+            if key in keys:
+                return
+            keys.add(key)
+        # Keys for the archive manifests wait in a pending file, shared by process pool workers
+        if ARCHIVE_MANIFEST and bucket in ARCHIVE_MANIFESTS:
+            os.makedirs(INDEX_PATH, exist_ok=True)
+            with open(INDEX_PATH + bucket + '_archived.txt', 'a') as f:
+                f.write(key + '\n')
+
+
+def key_exists(bucket, key):
+    # Constant-time check against the index, with a head_object fallback for keys added since it was built
+    if key in get_key_index(bucket):
+        return True
+    with index_lock:
+        if key in absent_keys[bucket]:
+            absent_keys[bucket].discard(key)
+            return False
+    if not object_exists(s3_cdh, bucket, key):
+        return False
+    add_key(bucket, key)
+    return True
+
+
+def check_keys(pairs):
+    # Look up [(bucket, key)] missing from the indexes with concurrent head requests, ahead of a batch of uploads
+    build_key_indexes(sorted(set(bucket for bucket, key in pairs)))
+    pairs = [(bucket, key) for bucket, key in pairs if key not in bucket_keys[bucket]]
+    if not pairs:
+        return
+    for (bucket, key), found in objects_exist(s3_cdh, pairs).items():
+        if found:
+            add_key(bucket, key)
+        else:
+            with index_lock:
+                absent_keys[bucket].add(key)
+
+
+def archived_keys(bucket, keys):
+    # The keys already in a bucket - only keys missing from its index cost a head request
+    if ASYNC_S3:
+        check_keys([(bucket, key) for key in keys])
+    return set(key for key in keys if key_exists(bucket, key))
+
+
+def read_archive_manifest(bucket):
+    # {key: archived time} for a glacier bucket - the first run builds the manifest from one full listing
+    try:
+        manifest = pd.read_csv(io.BytesIO(read_object(s3_cdh, CDH_BUCKET_AUX, ARCHIVE_MANIFESTS[bucket])), dtype=str)
+        return dict(zip(manifest['key'], manifest['archived_time']))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+    print('Building archive manifest:', ARCHIVE_MANIFESTS[bucket])
+    archived = {item['Key']: item['LastModified'].strftime('%Y-%m-%d %H:%M:%S')
+                for item in list_bucket_objects(s3_cdh, bucket)}
+    write_archive_manifest(bucket, archived)
+    return archived
+
+
+def write_archive_manifest(bucket, archived):
+    manifest = pd.DataFrame(sorted(archived.items()), columns=['key','archived_time'])
+    s3_cdh.put_object(Bucket=CDH_BUCKET_AUX, Key=ARCHIVE_MANIFESTS[bucket], Body=manifest.to_csv(index=False).encode('utf-8'))
+
+
+def save_archive_manifests():
+    # Fold the pending archived keys into the manifests. The pending file is moved aside first, so keys added
+    # while the manifest is written wait for the next save - files left by an interrupted save are folded in too
+    with index_lock:
+        for bucket in ARCHIVE_MANIFESTS:
+            pending_file = INDEX_PATH + bucket + '_archived.txt'
+            if os.path.exists(pending_file):
+                os.replace(pending_file, pending_file + '.' + str(time.time_ns()))
+            saving = glob.glob(pending_file + '.*')
+            if not saving:
+                continue
+            keys = []
+            for file in saving:
+                with open(file) as f:
+                    keys.extend(line.strip() for line in f if line.strip())
+            try:
+                archived = read_archive_manifest(bucket)
+                now = strftime('%Y-%m-%d %H:%M:%S', gmtime())
+                for key in keys:
+                    archived.setdefault(key, now)
+                write_archive_manifest(bucket, archived)
+            except (ClientError, NoCredentialsError) as e:
+                print('Archive manifest not saved, its keys stay pending:', ARCHIVE_MANIFESTS[bucket], e)
+                continue
+            for file in saving:
+                os.remove(file)
+
+
+# In[33]:
 
 
+# Multipart settings for single-destination uploads
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=UPLOAD_PART_SIZE, multipart_chunksize=UPLOAD_PART_SIZE,
+                                 max_concurrency=UPLOAD_PART_CONCURRENCY)
+
 def upload_to_aws(local_file, bucket, s3_file, args_dict, overwrite=False):
-    if 'Contents' in s3_cdh.list_objects(Bucket=bucket).keys() and not overwrite:
-        uploaded = [item['Key'] for item in s3_cdh.list_objects(Bucket=bucket)['Contents']]
-    else:
-        uploaded = []
-    
-    if s3_file not in uploaded:
+    if overwrite or not key_exists(bucket, s3_file):
         try:
             print('Now uploading: ', s3_file)
-            s3_cdh.upload_file(Filename=local_file, Bucket=bucket, Key=s3_file, ExtraArgs=args_dict)
+            with stage('upload', s3_file.split('_')[0], bucket=bucket, key=s3_file, bytes_in=file_size(local_file)):
+                s3_cdh.upload_file(Filename=local_file, Bucket=bucket, Key=s3_file, ExtraArgs=args_dict, Config=TRANSFER_CONFIG)
+            add_key(bucket, s3_file)
             print("Upload Successful")
             return True
         except FileNotFoundError:
@@ -306,13 +2195,175 @@ def upload_to_aws(local_file, bucket, s3_file, args_dict, overwrite=False):
             return False
 
 
-# In[10]:
+# In[34]:
+
+
+def list_files(path, pattern, names=None):
+    # Files in path matching pattern, optionally only those whose names start with one of names
+    files = glob.glob(path + pattern)
+    if names is not None:
+        files = [file for file in files if file.split('/')[-1].startswith(tuple(names))]
+    return files
+
+
+# In[35]:
+
+
+def is_review_file(file):
+    return '_reviews' in file.split('/')[-1]
+
+
+def master_files(names=None, hold_reviews=True):
+    # Local master files to upload - ref-only review files wait for the review store backup in save_stores
+    files = [file for pattern in MASTER_FILE_PATTERNS for file in list_files(MASTER_PATH, pattern, names)]
+    if REVIEW_REFS_ONLY and hold_reviews:
+        files = [file for file in files if not is_review_file(file)]
+    return files
+
+
+def upload_jobs(names=None, hold_reviews=True):
+    # Each local file with every (bucket, key, args, overwrite) it goes to - the same destinations as the save_files loops
+    jobs = []
+    for file in list_files(ZIP_PATH, '*.gz', names):
+        jobs.append((file, [(CDH_BUCKET_ZIP_GLACIER, file.split(ZIP_PATH)[-1], {'StorageClass': 'DEEP_ARCHIVE'}, False)]))
+    for file in list_files(JSON_PATH, '*.json', names):
+        jobs.append((file, [(CDH_BUCKET_JSON_GLACIER, file.split(JSON_PATH)[-1], {'StorageClass': 'DEEP_ARCHIVE'}, False)]))
+    for file in master_files(names, hold_reviews):
+        jobs.append((file, [(CDH_BUCKET_MASTER_GLACIER, file.split(MASTER_PATH)[-1], dict(content_args(file), StorageClass='DEEP_ARCHIVE'), False),
+                            (CDH_BUCKET_MASTER, file.split(MASTER_PATH)[-1], dict(content_args(file), StorageClass='STANDARD_IA'), False)]))
+    for file in list_files(SUMMARY_PATH, '*.csv', names):
+        jobs.append((file, [(CDH_BUCKET_AUX, file.split(SUMMARY_PATH)[-1], {'StorageClass': 'STANDARD'}, True)]))
+    return jobs
+
 
+def upload_fanout(file, destinations, part_pool):
+    # Upload one local file to all its destinations, reading each part from disk once
+    # Returns {bucket: True/False} - keys already in a bucket count as uploaded
+    results = {}
+    pending = []
+    for bucket, key, args_dict, overwrite in destinations:
+        if overwrite or not key_exists(bucket, key):
+            pending.append((bucket, key, args_dict))
+        else:
+            print('Already uploaded: ', key)
+            results[bucket] = True
+    if not pending:
+        return results
+
+    uploads = []
+    try:
+        print('Now uploading: ', file, 'to', ', '.join(bucket for bucket, key, args_dict in pending))
+        with stage('upload', file.split('/')[-1].split('_')[0], buckets=[bucket for bucket, key, args_dict in pending],
+                   key=pending[0][1], bytes_in=file_size(file)):
+            upload_parts(file, pending, uploads, part_pool)
+        for bucket, key, args_dict in pending:
+            add_key(bucket, key)
+            results[bucket] = True
+        print('Upload Successful: ', file)
+    except Exception as e:
+        print('Upload failed: ', file, e)
+        for bucket, key, upload_id, parts in uploads:
+            try:
+                s3_cdh.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                pass
+        for bucket, key, args_dict in pending:
+            results.setdefault(bucket, False)
+    return results
+
+
+def upload_parts(file, pending, uploads, part_pool):
+    # Single put per destination for small files, otherwise multipart uploads fed one part read at a time
+    # Open multipart uploads are kept in uploads, so the caller can abort them on failure
+    if os.path.getsize(file) <= UPLOAD_PART_SIZE:
+        with open(file, 'rb') as f:
+            body = f.read()
+        for bucket, key, args_dict in pending:
+            s3_cdh.put_object(Bucket=bucket, Key=key, Body=body, **args_dict)
+    else:
+        for bucket, key, args_dict in pending:
+            upload_id = s3_cdh.create_multipart_upload(Bucket=bucket, Key=key, **args_dict)['UploadId']
+            uploads.append((bucket, key, upload_id, []))
+        with open(file, 'rb') as f:
+            in_flight = set()
+            for part_number in itertools.count(1):
+                body = f.read(UPLOAD_PART_SIZE)
+                if not body:
+                    break
+                # The part is read once and sent to every destination
+                for bucket, key, upload_id, parts in uploads:
+                    in_flight.add(part_pool.submit(upload_part, bucket, key, upload_id, part_number, body, parts))
+                while len(in_flight) >= UPLOAD_PART_CONCURRENCY * len(uploads):
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in in_flight:
+                future.result()
+        for bucket, key, upload_id, parts in uploads:
+            s3_cdh.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])})
+        uploads.clear()
+
+
+def upload_part(bucket, key, upload_id, part_number, body, parts):
+    # Send one part of a multipart upload, recording its ETag for completion
+    response = s3_cdh.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body)
+    parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+
+def save_files_concurrent(names=None, workers=UPLOAD_WORKERS, hold_reviews=True):
+    # Upload every local file on a thread pool - a file is only removed once all of its destinations have it
+    jobs = upload_jobs(names, hold_reviews)
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as file_pool, \
+         ThreadPoolExecutor(max_workers=workers * UPLOAD_PART_CONCURRENCY * 2) as part_pool:
+        futures = {file_pool.submit(upload_fanout, file, destinations, part_pool): file for file, destinations in jobs}
+        for future in futures:
+            results[futures[future]] = future.result()
+
+    complete = True
+    for file, result in results.items():
+        if result and all(result.values()):
+            os.remove(file)
+        else:
+            print('File ', file, ' not uploaded! ', result)
+            complete = False
+    return complete, results
+
+
+# In[36]:
+
+
+def save_files(names=None, hold_reviews=True):
+    saved = upload_files(names, hold_reviews)
+    # Process pool workers leave their archived keys for the main process to save
+    if ARCHIVE_MANIFEST and multiprocessing.parent_process() is None:
+        save_archive_manifests()
+    return saved
+
+
+def upload_files(names=None, hold_reviews=True):
+    # Existence checks for the whole batch go out at once, rather than one per upload
+    if ASYNC_S3:
+        try:
+            check_keys([(bucket, key) for file, destinations in upload_jobs(names, hold_reviews)
+                        for bucket, key, args_dict, overwrite in destinations if not overwrite])
+        except Exception as e:
+            print('Batch key check failed, checking each upload instead:', e)
+
+    if UPLOAD_WORKERS > 1:
+        try:
+            complete, results = save_files_concurrent(names, hold_reviews=hold_reviews)
+        except:
+            print('File save incomplete! Please retry.')
+            return False
+        if not complete:
+            print('File save incomplete! Please retry.')
+        return complete
 
-def save_files():
     try:
         # Zip files: glacier
-        for file in glob.glob(ZIP_PATH + '*.gz'):
+        for file in list_files(ZIP_PATH, '*.gz', names):
             local_file_name = file
             aws_file_name = file.split(ZIP_PATH)[-1]
             bucket_name = CDH_BUCKET_ZIP_GLACIER
@@ -327,7 +2378,7 @@ def save_files():
                 print('File ', file, ' not uploaded!')
 
         # JSON files: glacier
-        for file in glob.glob(JSON_PATH + '*.json'):
+        for file in list_files(JSON_PATH, '*.json', names):
             local_file_name = file
             aws_file_name = file.split(JSON_PATH)[-1]
             bucket_name = CDH_BUCKET_JSON_GLACIER
@@ -342,12 +2393,12 @@ def save_files():
                 print('File ', file, ' not uploaded!')
 
         # Master files: glacier
-        for file in glob.glob(MASTER_PATH + '*.csv'):
+        for file in master_files(names, hold_reviews):
             local_file_name = file
             aws_file_name = file.split(MASTER_PATH)[-1]
             bucket_name = CDH_BUCKET_MASTER_GLACIER
 
-            args_dict=dict()
+            args_dict=content_args(file)
             args_dict['StorageClass']='DEEP_ARCHIVE'
 
             uploaded = upload_to_aws(local_file_name, bucket_name, aws_file_name, args_dict)
@@ -357,12 +2408,12 @@ def save_files():
                 print('File ', file, ' not uploaded!')
 
         # Master files: standard infrequent access
-        for file in glob.glob(MASTER_PATH + '*.csv'):
+        for file in master_files(names, hold_reviews):
             local_file_name = file
             aws_file_name = file.split(MASTER_PATH)[-1]
             bucket_name = CDH_BUCKET_MASTER
 
-            args_dict=dict()
+            args_dict=content_args(file)
             args_dict['StorageClass']='STANDARD_IA'
 
             uploaded = upload_to_aws(local_file_name, bucket_name, aws_file_name, args_dict)
@@ -372,7 +2423,7 @@ def save_files():
                 print('File ', file, ' not uploaded!')
                 
         # Summary files: standard
-        for file in glob.glob(SUMMARY_PATH + '*.csv'):
+        for file in list_files(SUMMARY_PATH, '*.csv', names):
             local_file_name = file
             aws_file_name = file.split(SUMMARY_PATH)[-1]
             bucket_name = CDH_BUCKET_AUX
@@ -395,13 +2446,385 @@ def save_files():
 
 # ### Step 4: Bringing it all together
 
-# In[11]:
+# In[37]:
+
+
+def manifest_file(file_name):
+    return MANIFEST_PATH + file_name + '_manifest.json'
+
+
+def load_manifest(file_name, name):
+    # Stage manifest of a snapshot - a fresh one if it has never been started (or was started from another zip)
+    if os.path.exists(manifest_file(file_name)):
+        with open(manifest_file(file_name)) as f:
+            manifest = json.load(f)
+        if manifest['name'] == name:
+            return manifest
+    return {'name': name, 'downloaded': False, 'decompressed': False, 'zip_bytes': None, 'json_bytes': None,
+            'parsed_offset': 0, 'parsed': False, 'segments': [], 'written': False, 'summary': None, 'uploaded': False}
 
 
-def process_files():
-    # Get file lists
-    yelp_zip_files = [[item['Key'], item['Key'].split('/')[-1]] for item in s3_yelp.list_objects_v2(Bucket=YELP_BUCKET, Prefix='upenn/')['Contents']]
-    cdh_zip_files = [item['Key'] for item in s3_cdh.list_objects_v2(Bucket=CDH_BUCKET_ZIP_GLACIER)['Contents']]
+def save_manifest(file_name, manifest):
+    # Written to a temporary file and moved into place, so a crash never leaves a half-written manifest
+    os.makedirs(MANIFEST_PATH, exist_ok=True)
+    manifest['updated'] = datetime.now().isoformat()
+    with open(manifest_file(file_name) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file(file_name) + '.tmp', manifest_file(file_name))
+
+
+def checkpoint_file(file_name, part):
+    return MANIFEST_PATH + file_name + '_' + part + '.pkl'
+
+
+def parse_checkpointed(file_name, json_file_path, manifest):
+    # Parse a snapshot in segments of CHECKPOINT_FACILITIES facilities - each segment's rows and its own summary
+    # accumulator are pickled and the byte offset it ended at is committed, so a rerun picks up from there.
+    # Only segments the manifest lists count, so nothing gets ahead of the committed offset.
+    if manifest['parsed_offset']:
+        print('Resuming', file_name, 'at byte', manifest['parsed_offset'], 'after', len(manifest['segments']), 'segments')
+    else:
+        manifest['parsed_offset'] = 0
+        manifest['segments'] = []
+
+    with open(json_file_path, 'rb') as f:
+        start = manifest['parsed_offset']
+        f.seek(start)
+        state = {}
+        facilities = decode_stream(f, state=state)
+        while True:
+            fac_data, cat_data, rev_data, segment_summary = extract_facilities(itertools.islice(facilities, CHECKPOINT_FACILITIES))
+            if segment_summary.fac_count == 0:
+                break
+            segment = checkpoint_file(file_name, 'segment%05d' % len(manifest['segments']))
+            with open(segment, 'wb') as out:
+                pickle.dump((fac_data, cat_data, rev_data, segment_summary), out, protocol=pickle.HIGHEST_PROTOCOL)
+            manifest['segments'].append(segment)
+            manifest['parsed_offset'] = start + stream_offset(state)
+            save_manifest(file_name, manifest)
+            print(len(manifest['segments']), 'segments checkpointed at byte', manifest['parsed_offset'])
+
+    # Partial outputs and summaries are merged in segment order
+    tables = new_tables()
+    summary = SummaryAccumulator()
+    for segment in manifest['segments']:
+        with open(segment, 'rb') as f:
+            fac_data, cat_data, rev_data, segment_summary = pickle.load(f)
+        extend_tables(tables, (fac_data, cat_data, rev_data))
+        summary.merge(segment_summary)
+    return tables + [summary]
+
+
+def process_snapshot_checkpointed(file, name, summary_rows=None):
+    # Download, unzip, parse, write and upload a snapshot, skipping stages its manifest records as done
+    zip_file_path = ZIP_PATH+name
+    json_file_path = (JSON_PATH+name).split('.gz')[0]
+    file_name = name.split('_')[0]
+    manifest = load_manifest(file_name, name)
+
+    # Downloaded and decompressed - only trusted if the local files are still there, whole
+    if not (manifest['decompressed'] and file_size(json_file_path) == manifest['json_bytes']):
+        if not (manifest['downloaded'] and file_size(zip_file_path) == manifest['zip_bytes']):
+            if not get_new_file(file, zip_file_path, json_file_path, decompress=False):
+                return False
+            manifest.update(downloaded=True, zip_bytes=file_size(zip_file_path), decompressed=False, parsed_offset=0)
+            save_manifest(file_name, manifest)
+        if not unzip_file(zip_file_path, json_file_path):
+            return False
+        manifest.update(decompressed=True, json_bytes=file_size(json_file_path), parsed_offset=0)
+        save_manifest(file_name, manifest)
+
+    # Parsed through the last committed offset, then written
+    if not manifest['written']:
+        try:
+            print('Now processing:', file_name)
+            with stage('parse', file_name, resumed_at=manifest['parsed_offset'], checkpointed=True) as record:
+                fac_data, cat_data, rev_data, summary = parse_checkpointed(file_name, json_file_path, manifest)
+                record['rows'] = summary.fac_count
+                record['bytes_in'] = manifest['json_bytes']
+            manifest['parsed'] = True
+            save_manifest(file_name, manifest)
+            manifest['summary'] = finish_file(file_name, fac_data, cat_data, rev_data, summary, summary_rows,
+                                              extract_fields() == 'summary')
+            del fac_data, cat_data, rev_data
+        except Exception as e:
+            print('Data extraction failed at byte', manifest['parsed_offset'], '- rerun to resume:', e)
+            return False
+        manifest['written'] = True
+        save_manifest(file_name, manifest)
+    elif summary_rows is not None and not SUMMARY_STORE:
+        summary_rows.append(manifest['summary'])
+
+    # Uploaded - the manifest and checkpoints are only cleared once everything is in s3
+    # The summary history goes up with the snapshot unless the caller collects summary rows
+    names = [name.split('.gz')[0], file_name+'_'] + (['daily_data.csv'] if summary_rows is None else [])
+    if not save_files(names=names):
+        print('There was a problem saving the files:', name)
+        return False
+    for segment in manifest['segments']:
+        if os.path.exists(segment):
+            os.remove(segment)
+    manifest.update(uploaded=True, segments=[])
+    save_manifest(file_name, manifest)
+
+    return True
+
+
+# In[38]:
+
+
+def process_snapshot(file, name):
+    # Download, extract and upload a single snapshot - returns its summary rows, or False on failure
+    zip_file_path = ZIP_PATH+name
+    json_file_path = (JSON_PATH+name).split('.gz')[0]
+    file_name = name.split('_')[0]
+    summary_rows = []
+
+    if CHECKPOINTS:
+        return summary_rows if process_snapshot_checkpointed(file, name, summary_rows) else False
+    if not get_new_file(file, zip_file_path, json_file_path, decompress=not STREAM_FROM_GZIP):
+        print('There was a problem extracting the zip and json files:', name)
+        return False
+    if STREAM_FROM_GZIP:
+        extracted = extract_zip_data(zip_file_path, json_file_path, summary_rows=summary_rows)
+    else:
+        extracted = extract_data(files=[json_file_path], summary_rows=summary_rows)
+    if not extracted:
+        print('There was a problem extracting the data:', name)
+        return False
+    if not save_files(names=[name.split('.gz')[0], file_name+'_']):
+        print('There was a problem saving the files:', name)
+        return False
+
+    return summary_rows
+
+
+# In[39]:
+
+
+def process_files_parallel(snapshots, workers=PROCESS_WORKERS, disk_budget=LOCAL_DISK_BUDGET):
+    # Spread snapshots over a process pool, only starting a snapshot when its estimated disk use fits the budget
+    # Key indexes are built and stores restored before the pool forks, so workers don't each list the buckets
+    # or download the stores again
+    build_key_indexes([CDH_BUCKET_ZIP_GLACIER, CDH_BUCKET_JSON_GLACIER, CDH_BUCKET_MASTER_GLACIER, CDH_BUCKET_MASTER])
+    restore_stores()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    queue = list(snapshots)
+    pending = {}
+    reserved = 0
+    summary_rows = []
+    success = True
+
+    while pending or (queue and success):
+        while queue and success and len(pending) < workers:
+            file, name, size = queue[0]
+            needed = size * DISK_EXPANSION_FACTOR
+            available = min(disk_budget, shutil.disk_usage(BASE_PATH).free)
+            if pending and reserved + needed > available:
+                break
+            queue.pop(0)
+            print('Now processing snapshot:', name)
+            pending[pool.submit(process_snapshot, file, name)] = (name, needed)
+            reserved += needed
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            name, needed = pending.pop(future)
+            reserved -= needed
+            try:
+                result = future.result()
+            except Exception as e:
+                print('Snapshot', name, 'raised:', e)
+                result = False
+            # Stop handing out new snapshots after a failure, but let running ones finish
+            if result is False:
+                success = False
+            else:
+                summary_rows.extend(result)
+    pool.shutdown()
+
+    # Keys the workers archived are saved to the manifests here
+    if ARCHIVE_MANIFEST:
+        save_archive_manifests()
+
+    # Summary history is shared by all snapshots, so it is only updated here, in date order
+    if not save_summaries(summary_rows):
+        success = False
+
+    return success
+
+
+def save_summaries(summary_rows):
+    # Add collected summary rows to the history in date order and upload it
+    if not summary_rows:
+        return True
+    summary_rows = sorted(summary_rows, key=lambda row: row[0])
+    update_summary(summary_rows)
+    if not save_files(names=['daily_data.csv'] + [row[0]+'_daily_data.csv' for row in summary_rows]):
+        return False
+    clear_pending_summaries(summary_rows)
+    return True
+
+
+# In[40]:
+
+
+def process_files_pipelined(snapshots, queue_size=PIPELINE_QUEUE_SIZE, disk_budget=LOCAL_DISK_BUDGET):
+    # Download, parse and upload consecutive snapshots at the same time - snapshot N+1 downloads while N parses
+    # and N-1 uploads. Transfers run on threads and parsing stays on this one, with bounded queues in between.
+    # A download only starts once the disk reserved by snapshots still on local disk leaves room for it
+    parse_queue = queue.Queue(maxsize=queue_size)
+    upload_queue = queue.Queue(maxsize=queue_size)
+    failed = threading.Event()
+    disk = threading.Condition()
+    reserved = {'bytes': 0}
+    summary_rows = []
+
+    # Range parsing forks a process pool, and forking while the transfer threads hold locks (stdout, the key
+    # index, boto3's connection pools) can leave a child waiting on a lock nobody will release
+    if PARSE_WORKERS > 1:
+        print('Range parsing forks while transfers are running - parsing each snapshot in a single stream.')
+
+    def put(stage_queue, item):
+        # Blocks while the next stage is busy - gives up if another stage has failed
+        while not failed.is_set():
+            try:
+                stage_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(stage_queue):
+        # Next snapshot for a stage, or None at the end of the run or after a failure
+        while not failed.is_set():
+            try:
+                return stage_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def release(needed):
+        with disk:
+            reserved['bytes'] -= needed
+            disk.notify_all()
+
+    def download_stage():
+        for file, name, size in snapshots:
+            needed = size * DISK_EXPANSION_FACTOR
+            with disk:
+                while (reserved['bytes'] and not failed.is_set() and
+                       reserved['bytes'] + needed > min(disk_budget, shutil.disk_usage(BASE_PATH).free)):
+                    disk.wait(timeout=5)
+                reserved['bytes'] += needed
+            if failed.is_set() or not get_new_file(file, ZIP_PATH+name, (JSON_PATH+name).split('.gz')[0], decompress=not STREAM_FROM_GZIP):
+                print('There was a problem extracting the zip and json files:', name)
+                release(needed)
+                failed.set()
+                return
+            if not put(parse_queue, (name, needed)):
+                release(needed)
+                return
+        put(parse_queue, None)
+
+    def upload_stage():
+        while True:
+            item = get(upload_queue)
+            if item is None:
+                return
+            name, needed = item
+            saved = save_files(names=[name.split('.gz')[0], name.split('_')[0]+'_'])
+            release(needed)
+            if not saved:
+                print('There was a problem saving the files:', name)
+                failed.set()
+                return
+
+    downloader = threading.Thread(target=download_stage, name='download')
+    uploader = threading.Thread(target=upload_stage, name='upload')
+    downloader.start()
+    uploader.start()
+
+    # Parse stage - snapshots are parsed one at a time, in order, so deltas and the review store stay sequential
+    while True:
+        item = get(parse_queue)
+        if item is None:
+            break
+        name, needed = item
+        zip_file_path = ZIP_PATH+name
+        json_file_path = (JSON_PATH+name).split('.gz')[0]
+        if STREAM_FROM_GZIP:
+            extracted = extract_zip_data(zip_file_path, json_file_path, summary_rows=summary_rows)
+        else:
+            extracted = extract_data(files=[json_file_path], summary_rows=summary_rows, workers=1)
+        if not extracted:
+            print('There was a problem extracting the data:', name)
+            release(needed)
+            failed.set()
+            break
+        if not put(upload_queue, item):
+            release(needed)
+            break
+    put(upload_queue, None)
+
+    downloader.join()
+    uploader.join()
+
+    # Summary history is shared by all snapshots, so it is only updated here, in date order
+    # Rows of every parsed snapshot are kept, even after a failed upload - a rerun finds their master
+    # files on local disk and uploads them without parsing again, like the sequential run
+    # Each row went to its pending file before the snapshot was queued for upload, so if this run is killed
+    # after its zips are archived, the next run still adds the rows to the history
+    if not save_summaries(summary_rows):
+        return False
+    return not failed.is_set()
+
+
+# In[41]:
+
+
+def process_files(workers=PROCESS_WORKERS):
+    # Get file lists - archived zips are looked up in the zip bucket's key index, not listed
+    yelp_zip_files = [[item['Key'], item['Key'].split('/')[-1], item['Size']] for item in list_bucket_objects(s3_yelp, YELP_BUCKET, 'upenn/')]
+    cdh_zip_files = archived_keys(CDH_BUCKET_ZIP_GLACIER, [item[1] for item in yelp_zip_files])
+    # Archived zips missing from the manifest were found by their head requests - they are added back here
+    if ARCHIVE_MANIFEST:
+        save_archive_manifests()
+
+    # Rows a killed run collected, but never added to the history, go in first - their zips may already be archived
+    pending_rows = load_pending_summaries()
+    if pending_rows:
+        print('Adding', len(pending_rows), 'summary rows left by an earlier run.')
+        if not save_summaries(pending_rows):
+            print('There was a problem saving the summary data! Now exiting.')
+            return False
+
+    # Deltas are taken against the previous day, so they need snapshots processed in order
+    if workers > 1 and WRITE_DELTAS:
+        print('Delta files need snapshots processed in order - processing sequentially.')
+        workers = 1
+
+    # Catch up on a backlog of snapshots across a process pool
+    if workers > 1:
+        snapshots = [item for item in yelp_zip_files if item[1] not in cdh_zip_files]
+        if not process_files_parallel(snapshots, workers):
+            print('There was a problem processing the snapshots! Now exiting.')
+            return False
+        if SUMMARY_STORE and not compact_summaries():
+            print('There was a problem compacting the summary records! Now exiting.')
+            return False
+        return save_stores()
+
+    # Overlap the stages of consecutive snapshots
+    if PIPELINE_STAGES and not CHECKPOINTS:
+        snapshots = [item for item in yelp_zip_files if item[1] not in cdh_zip_files]
+        if not process_files_pipelined(snapshots):
+            print('There was a problem processing the snapshots! Now exiting.')
+            return False
+        if SUMMARY_STORE and not compact_summaries():
+            print('There was a problem compacting the summary records! Now exiting.')
+            return False
+        return save_stores()
     
     # Process files
     for item in yelp_zip_files:
@@ -412,32 +2835,49 @@ def process_files():
         
         # Check if file has already been processed and archived - upload function MUST verify this
         if name not in cdh_zip_files:
+            # Stages already done by an earlier, failed run are skipped
+            if CHECKPOINTS:
+                if not process_snapshot_checkpointed(file, name):
+                    print('There was a problem processing the snapshot! Rerun to resume. Now exiting.')
+                    return False
+                continue
             # Extract zip and json files
-            if not get_new_file(file, zip_file_path, json_file_path):
+            if not get_new_file(file, zip_file_path, json_file_path, decompress=not STREAM_FROM_GZIP):
                 print('There was a problem extracting the zip and json files! Now exiting.')
                 return False
             # Process json file
-            if not extract_data():
+            if STREAM_FROM_GZIP:
+                extracted = extract_zip_data(zip_file_path, json_file_path)
+            else:
+                extracted = extract_data()
+            if not extracted:
                 print('There was a problem extracting the data! Now exiting.')
                 return False
             # Upload files to s3
             if not save_files():
                 print('There was a problem saving the files! Now exiting.')
                 return False
+
+    # Summary records are folded into the history once per run
+    if SUMMARY_STORE and not compact_summaries():
+        print('There was a problem compacting the summary records! Now exiting.')
+        return False
             
-    return True
+    return save_stores()
 
 
 # ## Main Program
 # * Add functionality here to shut down EC2 instance when complete and send email notification / add log record
 
-# In[12]:
+# In[42]:
 
 
-if process_files():
-    print('All files processed correctly! Our work here is done - See you next time!')
-else:
-    print('The program encountered an error! Please check the processing status and restart! =(')
+# Only run when executed as a script or notebook - the benchmark imports this module for its functions
+if __name__ == '__main__':
+    if process_files():
+        print('All files processed correctly! Our work here is done - See you next time!')
+    else:
+        print('The program encountered an error! Please check the processing status and restart! =(')
 
 
 # In[ ]:
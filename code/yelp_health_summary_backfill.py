@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Yelp Summary Backfill
+# * Recompute daily summary rows from the master files in yelp-master-files
+# * Each date is processed on a worker pool, reading the master csv's in chunks so large review files fit in memory
+# * Finished dates are checkpointed, so an interrupted backfill picks up where it stopped
+# * Rows are merged into daily_data.csv by date - rerunning a backfill replaces rows rather than adding them
+
+# In[1]:
+
+
+# Modules
+import pandas as pd
+
+import io
+import os
+import sys
+import json
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict
+
+import boto3
+from botocore.exceptions import NoCredentialsError, ClientError
+
+# The summary statistics, daily_data.csv columns and delta rebuilds are the pipeline's own
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import yelp_health_pipeline
+from yelp_health_pipeline import SummaryAccumulator, SUMMARY_COLS, REVIEW_STORE_NAME, rebuild_table
+
+
+# ## Program Parameters
+
+# In[2]:
+
+
+# Constants
+BASE_PATH = '/home/ec2-user/yelp/data/'
+SUMMARY_PATH = BASE_PATH + 'summary_files/'
+CHECKPOINT_PATH = BASE_PATH + 'backfill/'
+STORE_PATH = BASE_PATH + 'stores/' # the pipeline's review store, for the ratings of ref-only review files
+CHECKPOINT_NAME = 'summary_backfill_checkpoint.json'
+
+START_DATE = '20190430' # first date to backfill (inclusive)
+END_DATE = None # last date to backfill (inclusive) - None runs through the latest master files
+BACKFILL_WORKERS = 4 # dates processed concurrently
+CSV_CHUNK_ROWS = 500000 # rows read at a time from each master csv
+RESET_CHECKPOINT = False # start over instead of resuming from the checkpoint
+
+# Master csv extensions and how pandas decompresses each
+MASTER_COMPRESSIONS = {'.csv': None, '.csv.gz': 'gzip', '.csv.bz2': 'bz2', '.csv.xz': 'xz'}
+
+# Master csv columns each summary needs
+SUMMARY_USECOLS = {'categories': ['alias'], 'facilities': ['fac_rating','review_count'], 'reviews': ['rev_rating']}
+
+# CDH access parameters
+CDH_ACCESS_KEY_ID = "REDACTED"
+CDH_SECRET_ACCESS_KEY = "REDACTED"
+CDH_REGION = "us-east-2"
+
+CDH_BUCKET_MASTER = 'yelp-master-files'
+CDH_BUCKET_AUX = 'yelp-auxiliary-files'
+
+
+# In[3]:
+
+
+# Connect to aws resources - rebuild_table reads the deltas with the same client
+s3_cdh = boto3.client('s3', aws_access_key_id=CDH_ACCESS_KEY_ID, aws_secret_access_key=CDH_SECRET_ACCESS_KEY, region_name=CDH_REGION)
+yelp_health_pipeline.s3_cdh = s3_cdh
+
+
+# ## Function Definitions
+
+# In[4]:
+
+
+def list_master_keys(start_date=START_DATE, end_date=END_DATE):
+    # {date: {kind: key}} for the dates with a complete set of master csv's, plain or compressed,
+    # following list_objects_v2 pagination past 1,000 keys. Dates whose full csv's weren't uploaded
+    # (DELTA_ONLY_UPLOADS) but have a delta manifest are kept - the missing kinds are rebuilt from the deltas
+    keys = defaultdict(dict)
+    manifests = set()
+    for page in s3_cdh.get_paginator('list_objects_v2').paginate(Bucket=CDH_BUCKET_MASTER):
+        for item in page.get('Contents', []):
+            key = item['Key']
+            if key.endswith('_delta_manifest.json'):
+                manifests.add(key.split('_')[0])
+            if not key.endswith(tuple(MASTER_COMPRESSIONS)) or '_' not in key:
+                continue
+            date, kind = key.split('.csv')[0].split('_', 1)
+            if kind in SUMMARY_USECOLS:
+                keys[date][kind] = key
+
+    dates = [date for date in sorted(set(keys) | manifests) if date >= start_date and (end_date is None or date <= end_date)]
+    skipped = [date for date in dates if len(keys[date]) < len(SUMMARY_USECOLS) and date not in manifests]
+    if skipped:
+        print('Skipping', len(skipped), 'dates without a full set of master files or a delta manifest:', ', '.join(skipped))
+    return {date: keys[date] for date in dates if date not in skipped}
+
+
+def list_master_dates(start_date=START_DATE, end_date=END_DATE):
+    return list(list_master_keys(start_date, end_date))
+
+
+# In[5]:
+
+
+def master_columns(bucket, key):
+    # Header of a master csv - only the start of the object is read
+    body = s3_cdh.get_object(Bucket=bucket, Key=key)['Body']
+    compression = MASTER_COMPRESSIONS['.csv' + key.split('.csv')[-1]]
+    columns = list(pd.read_csv(body, nrows=0, compression=compression).columns)
+    body.close()
+    return columns
+
+
+def read_chunks(bucket, source, columns, chunk_rows=CSV_CHUNK_ROWS):
+    # A master csv read in chunks, or a table already rebuilt from its deltas as a single chunk
+    if isinstance(source, pd.DataFrame):
+        return [source[columns]]
+    body = s3_cdh.get_object(Bucket=bucket, Key=source)['Body']
+    compression = MASTER_COMPRESSIONS['.csv' + source.split('.csv')[-1]]
+    return pd.read_csv(body, usecols=columns, chunksize=chunk_rows, compression=compression)
+
+
+def value_counts(bucket, source, columns, chunk_rows=CSV_CHUNK_ROWS):
+    # Exact value counts for each column of a master csv or rebuilt table - returns ({col: {value: count}}, row count)
+    # Missing values are counted under None
+    counts = {col: defaultdict(int) for col in columns}
+    rows = 0
+    for chunk in read_chunks(bucket, source, columns, chunk_rows):
+        rows += len(chunk)
+        for col in columns:
+            for value, count in chunk[col].value_counts(dropna=False).items():
+                counts[col][None if pd.isna(value) else value] += int(count)
+    return counts, rows
+
+
+def open_review_store():
+    # The pipeline's review store, downloaded from the auxiliary bucket if it isn't on this machine
+    # Workers download to their own temporary file, so one never opens another's partial copy
+    local_file = STORE_PATH + REVIEW_STORE_NAME
+    if not os.path.exists(local_file):
+        os.makedirs(STORE_PATH, exist_ok=True)
+        s3_cdh.download_file(Bucket=CDH_BUCKET_AUX, Key='stores/' + REVIEW_STORE_NAME, Filename=local_file + '.%d' % os.getpid())
+        os.replace(local_file + '.%d' % os.getpid(), local_file)
+    return sqlite3.connect(local_file, timeout=600)
+
+
+def store_rating_counts(bucket, source, chunk_rows=CSV_CHUNK_ROWS):
+    # rev_rating value counts of a ref-only review file (written with REVIEW_REFS_ONLY), looked up in the review
+    # store by rev_id - a rev_id the store doesn't have fails the date rather than skewing its summary
+    # The store keeps the rating a review had when it was first seen
+    id_counts = defaultdict(int)
+    rows = 0
+    con = open_review_store()
+    try:
+        for chunk in read_chunks(bucket, source, ['rev_id'], chunk_rows):
+            rows += len(chunk)
+            for rev_id, count in chunk['rev_id'].value_counts(dropna=False).items():
+                id_counts[rev_id] += int(count)
+        rev_ids = list(id_counts)
+        ratings = {}
+        for i in range(0, len(rev_ids), 500):
+            chunk = rev_ids[i:i+500]
+            ratings.update(con.execute('SELECT rev_id, rev_rating FROM reviews WHERE rev_id IN (%s)' % ','.join('?' * len(chunk)),
+                                       chunk).fetchall())
+    finally:
+        con.close()
+
+    missing = [rev_id for rev_id in rev_ids if rev_id not in ratings]
+    if missing:
+        raise ValueError('%d rev_ids of %s are not in the review store' % (len(missing), 'the rebuilt reviews' if isinstance(source, pd.DataFrame) else source))
+    counts = {'rev_rating': defaultdict(int)}
+    for rev_id, count in id_counts.items():
+        counts['rev_rating'][ratings[rev_id]] += count
+    return counts, rows
+
+
+def summarize_date(date, keys=None):
+    # Summary row for one date, in the daily_data.csv column order - keys maps each kind to its master csv
+    # Kinds without a master csv are rebuilt from the base snapshot and deltas, whole
+    if keys is None:
+        keys = {kind: date + '_' + kind + '.csv' for kind in SUMMARY_USECOLS}
+    sources = {kind: keys[kind] if kind in keys else rebuild_table(date, kind, CDH_BUCKET_MASTER) for kind in SUMMARY_USECOLS}
+    cat_counts, cat_rows = value_counts(CDH_BUCKET_MASTER, sources['categories'], SUMMARY_USECOLS['categories'])
+    fac_counts, fac_rows = value_counts(CDH_BUCKET_MASTER, sources['facilities'], SUMMARY_USECOLS['facilities'])
+    if isinstance(sources['reviews'], pd.DataFrame):
+        rev_columns = list(sources['reviews'].columns)
+    else:
+        rev_columns = master_columns(CDH_BUCKET_MASTER, sources['reviews'])
+    if 'rev_rating' in rev_columns:
+        rev_counts, rev_rows = value_counts(CDH_BUCKET_MASTER, sources['reviews'], SUMMARY_USECOLS['reviews'])
+    else:
+        rev_counts, rev_rows = store_rating_counts(CDH_BUCKET_MASTER, sources['reviews'])
+
+    # The pipeline's accumulator, filled from the value counts - a missing alias counts once, like Series.unique
+    summary = SummaryAccumulator()
+    summary.aliases = set(cat_counts['alias'])
+    summary.fac_count = fac_rows
+    summary.fac_ratings = fac_counts['fac_rating']
+    summary.review_counts = fac_counts['review_count']
+    summary.rev_count = rev_rows
+    summary.rev_ratings = rev_counts['rev_rating']
+    return summary.summary(date)
+
+
+# In[6]:
+
+
+def load_checkpoint(reset=RESET_CHECKPOINT):
+    # Summary rows of dates already backfilled, keyed by date
+    checkpoint_file = CHECKPOINT_PATH + CHECKPOINT_NAME
+    if reset or not os.path.exists(checkpoint_file):
+        return {}
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def save_checkpoint(done):
+    # Written to a temporary file and moved into place, so an interruption never leaves a partial checkpoint
+    os.makedirs(CHECKPOINT_PATH, exist_ok=True)
+    checkpoint_file = CHECKPOINT_PATH + CHECKPOINT_NAME
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(done, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def clear_checkpoint():
+    # Once the rows are merged, a later backfill over the same dates recomputes them from the master files
+    if os.path.exists(CHECKPOINT_PATH + CHECKPOINT_NAME):
+        os.remove(CHECKPOINT_PATH + CHECKPOINT_NAME)
+
+
+def init_worker():
+    # boto3 clients aren't shared across processes - each worker gets its own
+    global s3_cdh
+    s3_cdh = boto3.client('s3', aws_access_key_id=CDH_ACCESS_KEY_ID, aws_secret_access_key=CDH_SECRET_ACCESS_KEY, region_name=CDH_REGION)
+    yelp_health_pipeline.s3_cdh = s3_cdh
+
+
+def backfill_summaries(dates, workers=BACKFILL_WORKERS, keys=None):
+    # Summarize every date not yet in the checkpoint, checkpointing each one as it finishes
+    done = load_checkpoint()
+    todo = [date for date in dates if date not in done]
+    print(len(dates) - len(todo), 'dates already backfilled,', len(todo), 'to go...')
+
+    success = True
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_worker) as pool:
+        futures = {pool.submit(summarize_date, date, keys[date] if keys else None): date for date in todo}
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                done[date] = future.result()
+            except Exception as e:
+                print('Date', date, 'could not be summarized:', e)
+                success = False
+                continue
+            save_checkpoint(done)
+            print('Date', date, 'summarized -', len(done), 'dates done')
+
+    return success, [done[date] for date in dates if date in done]
+
+
+# In[7]:
+
+
+def merge_summaries(summary_rows):
+    # Replace or add the backfilled dates in daily_data.csv and keep the history in date order
+    daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key='daily_data.csv')
+    # Round-trip parsing, so rows that aren't backfilled are written back unchanged
+    daily_data = pd.read_csv(io.BytesIO(daily_data['Body'].read()), index_col=0, float_precision='round_trip')
+    summary_data = pd.DataFrame(summary_rows, columns=SUMMARY_COLS, index=[0]*len(summary_rows))
+    summary_data['date'] = summary_data['date'].astype('int64')
+
+    daily_data = daily_data[~daily_data['date'].isin(summary_data['date'])]
+    daily_data = pd.concat([daily_data, summary_data]).sort_values('date', kind='mergesort')
+
+    os.makedirs(SUMMARY_PATH, exist_ok=True)
+    daily_data.to_csv(SUMMARY_PATH + 'daily_data.csv')
+    try:
+        s3_cdh.upload_file(Filename=SUMMARY_PATH + 'daily_data.csv', Bucket=CDH_BUCKET_AUX, Key='daily_data.csv',
+                           ExtraArgs={'StorageClass': 'STANDARD'})
+    except (ClientError, NoCredentialsError) as e:
+        print('Summary upload failed:', e)
+        return False
+    os.remove(SUMMARY_PATH + 'daily_data.csv')
+    print(len(summary_data), 'summary rows merged into daily_data.csv')
+    return True
+
+
+def run_backfill(start_date=START_DATE, end_date=END_DATE, workers=BACKFILL_WORKERS):
+    keys = list_master_keys(start_date, end_date)
+    dates = list(keys)
+    print('Backfilling', len(dates), 'dates from', start_date, 'to', end_date or 'latest')
+    success, summary_rows = backfill_summaries(dates, workers, keys)
+    if not success:
+        print('Some dates failed - rerun to resume from the checkpoint.')
+        return False
+    if summary_rows and not merge_summaries(summary_rows):
+        return False
+    clear_checkpoint()
+    return True
+
+
+# ## Main Program
+
+# In[8]:
+
+
+if __name__ == '__main__':
+    if run_backfill():
+        print('Summary backfill complete!')
+    else:
+        print('The backfill encountered an error! Please rerun to resume from the checkpoint.')
@@ -33,7 +33,7 @@ from json import JSONDecoder, JSONDecodeError
 from collections import defaultdict
 
 import boto3
-from botocore.exceptions import NoCredentialsError
+from botocore.exceptions import NoCredentialsError, ClientError
 from boto.s3.connection import S3Connection
 from boto.glacier.layer1 import Layer1
 from boto.glacier.concurrent import ConcurrentUploader
@@ -53,6 +53,7 @@ get_ipython().run_line_magic('matplotlib', 'inline')
 
 # Constants
 MASTER_DATE_FORMAT = '%Y%m%d'
+MAX_DAYS_BACK = 7 # days to walk back looking for the latest date in the summary history
 
 # CDH access parameters
 CDH_ACCESS_KEY_ID = "REDACTED"
@@ -73,6 +74,7 @@ DATA_PATH = PROJECT_PATH + 'data/'
 OUTPUT_PATH = PROJECT_PATH + 'output/'
 
 DATA_SUMMARY_PATH = DATA_PATH + 'summary/'
+CACHE_PATH = DATA_PATH + 'cache/' # local copies of the summary history, revalidated against s3 by ETag
 
 
 # In[6]:
@@ -105,6 +107,64 @@ def get_date_str(date, formatted=False):
     return date
 
 
+# In[9]:
+
+
+def get_cached_object(bucket, key):
+    # Local copy of an s3 object, downloaded only if its ETag changed - returns (path, etag), or None if it doesn't exist
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    path = CACHE_PATH + key
+    meta_path = path + '.etag'
+    etag = None
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            etag = f.read().strip()
+    try:
+        if etag:
+            obj = s3_cdh.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+        else:
+            obj = s3_cdh.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            return path, etag
+        if code in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    with open(path, 'wb') as f:
+        f.write(obj['Body'].read())
+    with open(meta_path, 'w') as f:
+        f.write(obj['ETag'])
+    return path, obj['ETag']
+
+
+def load_daily_data(date, days_back=MAX_DAYS_BACK):
+    # Summary history through the latest date on or before date - the rolling daily_data.csv is cached by ETag,
+    # parsed once per version and kept as a pickle with parsed dates, and the dates are sliced locally
+    cached = get_cached_object(CDH_BUCKET_AUX, 'daily_data.csv')
+    if cached is None:
+        raise FileNotFoundError('No summary history in ' + CDH_BUCKET_AUX)
+    path, etag = cached
+    frame_path = path + '.' + etag.strip('"') + '.pkl'
+    if os.path.exists(frame_path):
+        daily_data = pd.read_pickle(frame_path)
+    else:
+        daily_data = pd.read_csv(path, index_col=0)
+        daily_data['formatted_date'] = pd.to_datetime(daily_data['date'].astype('str'), format=MASTER_DATE_FORMAT).dt.date
+        daily_data['date'] = daily_data['date'].astype('str')
+        for old in glob.glob(path + '.*.pkl'):
+            os.remove(old)
+        daily_data.to_pickle(frame_path)
+
+    daily_data = daily_data[daily_data['formatted_date'] <= date]
+    if len(daily_data) == 0 or (date - daily_data['formatted_date'].max()).days > days_back:
+        raise FileNotFoundError('No summary history in the last ' + str(days_back) + ' days')
+    day = daily_data['formatted_date'].max()
+    if day != date:
+        print('Data not available for', date, 'Using', day)
+    return daily_data, day
+
+
 # ## Extract Data From AWS
 
 # In[10]:
@@ -125,22 +185,10 @@ dates = [get_date_str(start_date),get_date_str(end_date)]
 
 # In[12]:
 
-# Get daily data summary for last week
-try:
-    name = get_date_str(current_date) + '_daily_data.csv'
-    daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key=name)
-except:
-    print('Data not available for',current_date,'Using previous day.')
-    current_date = current_date - pd.to_timedelta(1,unit='days')
-    name = get_date_str(current_date) + '_daily_data.csv'
-    daily_data = s3_cdh.get_object(Bucket=CDH_BUCKET_AUX, Key=name)
-    
-daily_data = pd.read_csv(io.BytesIO(daily_data['Body'].read()), index_col=0)
+# Get daily data summary for last week - the latest history is revalidated against the local cache
+daily_data, current_date = load_daily_data(current_date)
 
-# Adjust columns and extract weekly data
-formatted_dates = [datetime.strptime(str(item), MASTER_DATE_FORMAT).date() for item in daily_data.date]
-daily_data['formatted_date'] = formatted_dates
-daily_data['date'] = daily_data['date'].astype('str')
+# Extract weekly data
 weekly_df = daily_data[daily_data['date'].isin(dates)]
 
 